@@ -0,0 +1,52 @@
+"""
+Бенчмарк разбиения на чанки: RecursiveCharacterTextSplitter, создаваемый на каждый вызов (как было),
+против закэшированного SplitterEngine. Проверяет, что чанки совпадают, и печатает ускорение.
+Запуск из корня репозитория: python benchmarks/splitter_benchmark.py [папка с документами]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag_processor import DBConstructor, RecursiveCharacterTextSplitter
+
+data_folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.getcwd(), "Data_Base")
+repeats = 5
+
+# Разделители из docxparser.py
+params = {
+    'separators': [
+        r'^\d+\.*',
+        r'\n+',
+        r'(?<=\.)\s*\n',
+        r'(?<=[;]\n)',
+        r'(?<=\.\s)',
+    ],
+    'is_separator_regex': True,
+    'chunk_overlap': 0
+}
+
+constructor = DBConstructor()
+texts = []
+for folder, _, files in os.walk(data_folder):
+    for name in sorted(files):
+        if name.endswith(constructor.SUPPORTED_EXTENSIONS):
+            texts.extend(chunk.page_content for chunk in constructor.document_parser(os.path.join(folder, name)))
+
+print(f"Документы: {data_folder}")
+print(f"Исходных чанков: {len(texts)}, символов: {sum(map(len, texts))}")
+
+for chunk_size in (700, 900):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        old_chunks = [RecursiveCharacterTextSplitter(chunk_size=chunk_size, **params).split_text(text) for text in texts]
+    old_time = (time.perf_counter() - started) / repeats
+
+    started = time.perf_counter()
+    for _ in range(repeats):
+        new_chunks = constructor.split_texts_recursive(texts, chunk_size, **params)
+    new_time = (time.perf_counter() - started) / repeats
+
+    print(f"chunk_size={chunk_size}: совпадение {'да' if old_chunks == new_chunks else 'НЕТ'}, "
+          f"было {old_time * 1000:.1f} мс, стало {new_time * 1000:.1f} мс, ускорение x{old_time / new_time:.1f}")
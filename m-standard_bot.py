@@ -18,6 +18,11 @@ from pydantic import BaseModel, Field, ValidationError
 
 import csv
 import os
+import hashlib
+import functools
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from github import Github, GithubException
 
@@ -59,6 +64,17 @@ class Config:
     GENERATION_K = 4  # Новый параметр для генерации
     TEXT_K = 3
     TABLE_K = 3
+    TABLE_QUOTA = 1  # Сколько из GENERATION_K мест отдаётся слою таблиц, остальные - тексту
+    SCOPE_PAGE_SIZE = 20  # Документов на странице /scope (Telegram принимает не больше 100 кнопок)
+
+    INDEX_CACHE_MB = int(os.getenv("INDEX_CACHE_MB", 4096))  # Бюджет общего кэша баз категорий
+    WARM_PRELOAD = os.getenv("WARM_PRELOAD", "1") == "1"  # Загружать все категории при старте
+    LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", 4))  # Потоков для загрузки баз с диска
+    # Индексы через отображение в память (общие страницы для нескольких процессов бота): "1"/"0", пусто - как в metadata.json
+    FAISS_MMAP = {"1": True, "0": False}.get(os.getenv("FAISS_MMAP", ""))
+    # Сбор одновременных запросов в один батч модели эмбеддингов: окно ожидания и предельный размер
+    EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", 5))
+    EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
 
 # Валидация структуры файла
 class PromptsSchema(BaseModel):
@@ -222,9 +238,189 @@ class QueryLogger:
             print(f"⚠️ Unexpected error: {str(e)}")
             traceback.print_exc()
 
+class CacheEntry:
+    """Загруженные базы одной версии категории. Сессии хранят ссылку на запись, а не свои копии баз"""
+    def __init__(self, key: tuple, indexes: list, size_bytes: int, partitions: Optional[dict] = None):
+        self.key = key  # (путь категории, версия файлов)
+        self.indexes = indexes
+        self.partitions = partitions  # {element_type: индексы разделов} или None, если базы без разделов
+        self.size_bytes = size_bytes
+        self.refs = 0
+
+
+class IndexCache:
+    """
+    Общий для всех пользователей кэш баз категорий.
+    Ключ - путь категории и версия её файлов (пересобранная база загружается заново).
+    Записи считают ссылки сессий; записи без ссылок вытесняются по давности использования (LRU),
+    когда суммарный размер баз на диске превышает max_bytes. Одновременные запросы одной категории
+    ждут одну общую загрузку (single-flight).
+    """
+    def __init__(self, max_bytes: int, workers: int = 4):
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="faiss-load")
+        self.entries = OrderedDict()  # ключ -> CacheEntry, последний - использованный недавно
+        self.loading = {}  # ключ -> asyncio.Task загрузки
+        self.waiting = {}  # ключ -> сколько acquire ждут загрузку: их запись ещё без ссылок, но вытеснять её нельзя
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def index_paths(category_path: str) -> List[str]:
+        if os.path.exists(os.path.join(category_path, "index.faiss")):
+            # Сводная база категории (build_databases с merged_root): один индекс, один векторный запрос
+            return [category_path]
+        # Старая раскладка: отдельная база на каждый документ (папки разделов text_db / table_db не в счёт)
+        return DBConstructor.base_folders(category_path)
+
+    @staticmethod
+    def _files(paths: List[str]) -> List[str]:
+        """Файлы баз вместе с файлами их разделов"""
+        folders = [folder for path in paths
+                   for folder in [path, *(os.path.join(path, name) for name in DBConstructor.PARTITIONS.values())]
+                   if os.path.isdir(folder)]
+        return [os.path.join(folder, name) for folder in folders for name in sorted(os.listdir(folder))
+                if os.path.isfile(os.path.join(folder, name))]
+
+    def version(self, paths: List[str]) -> str:
+        """Отпечаток файлов баз: имена, размеры и время изменения"""
+        digest = hashlib.sha1()
+        for file in self._files(paths):
+            stat = os.stat(file)
+            digest.update(f"{file}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _snapshot(self, category_path: str) -> Tuple[List[str], str]:
+        paths = self.index_paths(category_path)
+        return paths, self.version(paths)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self.entries.values())
+
+    async def acquire(self, category_path: str, progress: Optional[Callable] = None) -> CacheEntry:
+        """
+        Запись кэша с базами категории; сессия должна вернуть её через release.
+        :param progress: async-функция (доля от 0 до 1), вызывается во время загрузки с диска
+        """
+        # Обход папок и stat всех файлов категории - в потоке, чтобы не блокировать цикл событий
+        paths, version = await asyncio.to_thread(self._snapshot, category_path)
+        key = (os.path.abspath(category_path), version)
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            task = self.loading.get(key)
+            if task is None:
+                task = asyncio.create_task(self._load(key, paths, progress))
+                self.loading[key] = task
+                task.add_done_callback(lambda _: self.loading.pop(key, None))
+            # shield: отмена одного ожидающего не прерывает общую загрузку
+            self.waiting[key] = self.waiting.get(key, 0) + 1
+            try:
+                entry = await asyncio.shield(task)
+            finally:
+                self.waiting[key] -= 1
+                if not self.waiting[key]:
+                    del self.waiting[key]
+
+        entry.refs += 1
+        self._evict()
+        return entry
+
+    def release(self, entry: Optional[CacheEntry]):
+        if entry is None:
+            return
+        entry.refs = max(0, entry.refs - 1)
+        self._evict()
+
+    async def _load(self, key: tuple, paths: List[str], progress: Optional[Callable]) -> CacheEntry:
+        # Базы загружаются параллельно в пуле потоков кэша (общем для всех категорий), порядок сохраняется
+        loop = asyncio.get_running_loop()
+        futures = [loop.run_in_executor(self.executor, functools.partial(processor.faiss_loader, faiss_dir,
+                                                                         hybrid_mode=True, mmap=Config.FAISS_MMAP))
+                   for faiss_dir in paths]
+        done = 0
+        for future in asyncio.as_completed(futures):
+            await future
+            done += 1
+            if progress:
+                # Прогресс - сообщение первого ожидающего; его ошибка (сообщение удалено, текст не изменился)
+                # не должна срывать общую загрузку для остальных
+                try:
+                    await progress(done / len(paths))
+                except Exception as e:
+                    print(f"⚠️ Прогресс загрузки {key[0]} не обновлён: {str(e)}")
+                    progress = None
+
+        indexes = []
+        # Разделы по типу чанка используются, только если их описывают все базы категории
+        partitions = {element_type: [] for element_type in DBConstructor.PARTITIONS}
+        for faiss_dir, future in zip(paths, futures):
+            load_result = future.result()
+            # Разделы, покрывающие все чанки, загружаются вместо основной базы ("db" - None):
+            # тогда поиск без разделов, список документов и сборка статей идут по самим разделам
+            bases = [load_result["db"]] if load_result["db"] is not None else [
+                load_result[folder_name] for folder_name in DBConstructor.PARTITIONS.values()
+                if load_result[folder_name] is not None]
+            if load_result["success"] and bases:
+                indexes.extend(bases)
+                if load_result["partitions"] is None:
+                    partitions = None
+                elif partitions is not None:
+                    for element_type, folder_name in DBConstructor.PARTITIONS.items():
+                        if load_result[folder_name] is not None:
+                            partitions[element_type].append(load_result[folder_name])
+            else:
+                print(f"⚠️ База {faiss_dir} не загружена: {load_result['error'] or 'нет основной базы'}")
+        if not indexes:
+            raise FileNotFoundError(f"В {key[0]} нет загружаемых баз")
+
+        entry = CacheEntry(key, indexes, sum(os.path.getsize(f) for f in self._files(paths)), partitions)
+        self.entries[key] = entry
+        return entry
+
+    def _evict(self):
+        """
+        Удаляет неиспользуемые записи (без ссылок сессий и без ожидающих их acquire):
+        сначала устаревшие версии, затем самые давние сверх бюджета
+        """
+        newest = {}
+        for key in self.entries:
+            newest[key[0]] = key
+        for key, entry in list(self.entries.items()):
+            if entry.refs == 0 and key not in self.waiting and newest[key[0]] != key:
+                del self.entries[key]
+
+        total = self.total_bytes
+        for key, entry in list(self.entries.items()):
+            if total <= self.max_bytes:
+                break
+            if entry.refs == 0 and key not in self.waiting:
+                total -= entry.size_bytes
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "mb": round(self.total_bytes / 2 ** 20, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loading": len(self.loading)
+        }
+
 bot = Bot(token=Config.BOT_TOKEN)
 dp = Dispatcher()
 processor = DBConstructor()
+processor.embed_batch_window = Config.EMBED_BATCH_WINDOW_MS / 1000
+processor.embed_batch_size = Config.EMBED_BATCH_SIZE
+index_cache = IndexCache(Config.INDEX_CACHE_MB * 2 ** 20, workers=Config.LOAD_WORKERS)
+# Готовность бота: прогрев модели эмбеддингов и загрузка категорий при старте (/status)
+startup_report = {"ready": False, "embedding_warmup_s": None, "categories": {}, "total_s": None}
+warm_up_task = None
 user_sessions = {}
 prompt_manager = PromptManager()  # Читает prompts.yaml в первый раз
 answer_generator = GCProcessor(prompt_manager.get_prompts()["model_name"])  # Берёт модель из файла
@@ -235,8 +431,10 @@ logger = QueryLogger(
     branch="bot-logs"  # Существующая ветка
 )
 filters = [
-    {"element_type": "text", "_search_params": {"k": Config.TEXT_K, "fetch_k": (Config.TEXT_K * 10)//2, "lambda_mult": 0.6}},
-    {"element_type": "table", "_search_params": {"k": Config.TABLE_K, "fetch_k": (Config.TABLE_K * 10)//2, "lambda_mult": 0.4}}
+    {"element_type": "text", "_quota": Config.GENERATION_K - Config.TABLE_QUOTA,
+     "_search_params": {"k": Config.TEXT_K, "fetch_k": (Config.TEXT_K * 10)//2, "lambda_mult": 0.6}},
+    {"element_type": "table", "_quota": Config.TABLE_QUOTA,
+     "_search_params": {"k": Config.TABLE_K, "fetch_k": (Config.TABLE_K * 10)//2, "lambda_mult": 0.4}}
 ]
 
 # ====================== Инициализация ======================
@@ -256,10 +454,50 @@ async def on_startup(bot: Bot):
 
         print("✅ Эмбеддинги успешно загружены")
 
+        # Прогрев идёт в фоне: бот уже отвечает, а выбор категории во время загрузки присоединяется к ней
+        global warm_up_task
+        warm_up_task = asyncio.create_task(warm_up())
+
 
     except Exception as e:
         print(f"💥 Критическая ошибка при запуске: {str(e)}")
         raise
+async def warm_up():
+    """
+    Прогрев при старте: один пробный запрос к модели эмбеддингов (первая инференция самая медленная)
+    и, если Config.WARM_PRELOAD, параллельная загрузка всех категорий Config.FAISS_ROOT в общий кэш баз.
+    """
+    started = time.perf_counter()
+    try:
+        prefix = "query: " if processor.db_metadata.get("is_e5_model", False) else ""
+        await asyncio.to_thread(processor.embeddings.embed_query, prefix + "прогрев модели")
+        startup_report["embedding_warmup_s"] = round(time.perf_counter() - started, 3)
+        print(f"🔥 Модель эмбеддингов прогрета за {startup_report['embedding_warmup_s']} с")
+
+        if Config.WARM_PRELOAD:
+            categories = [d for d in sorted(os.listdir(Config.FAISS_ROOT))
+                          if os.path.isdir(os.path.join(Config.FAISS_ROOT, d))]
+
+            async def preload(category: str):
+                category_started = time.perf_counter()
+                try:
+                    entry = await index_cache.acquire(os.path.join(Config.FAISS_ROOT, category))
+                    index_cache.release(entry)  # Сессий у записи пока нет, при нехватке бюджета она вытесняется
+                    startup_report["categories"][category] = round(time.perf_counter() - category_started, 3)
+                except Exception as e:
+                    startup_report["categories"][category] = f"ошибка: {str(e)}"
+
+            # Параллельность ограничена пулом потоков кэша (Config.LOAD_WORKERS)
+            await asyncio.gather(*(preload(category) for category in categories))
+            print(f"📦 Категории загружены: {startup_report['categories']}, кэш: {index_cache.stats()}")
+    except Exception as e:
+        print(f"⚠️ Ошибка прогрева: {str(e)}")
+        traceback.print_exc()
+    finally:
+        startup_report["total_s"] = round(time.perf_counter() - started, 3)
+        startup_report["ready"] = True
+        print(f"✅ Бот готов, прогрев занял {startup_report['total_s']} с")
+
 # ====================== Команды ===========================
 # --------------------- Команда /start ---------------------
 @dp.message(Command("start"))
@@ -330,6 +568,84 @@ async def cmd_get_settings(message: types.Message):
         f"🌡 Температура: <code>{prompts['temperature']}</code>",
         parse_mode=ParseMode.HTML
     )
+# ---------------- Команда /scope Поиск по одному документу ----------------
+@dp.message(Command("scope"))
+async def cmd_scope(message: types.Message):
+    session = user_sessions.get(message.from_user.id)
+    if not session or not session["faiss_indexes"]:
+        await message.answer("❌ Сначала выберите категорию через /start")
+        return
+
+    documents = processor.list_documents(session["faiss_indexes"])
+    session["scope_documents"] = list(documents)
+    await message.answer("🔎 Где искать ответы?", reply_markup=scope_keyboard(list(documents.values()), 0))
+
+def scope_keyboard(titles: List[str], page: int) -> InlineKeyboardMarkup:
+    """Страница списка документов /scope: SCOPE_PAGE_SIZE кнопок и переход на соседние страницы"""
+    pages = max(1, -(-len(titles) // Config.SCOPE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * Config.SCOPE_PAGE_SIZE
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📚 Все документы категории", callback_data="scope_all")
+    for idx, title in enumerate(titles[start:start + Config.SCOPE_PAGE_SIZE], start):
+        builder.button(text=title[:60], callback_data=f"scope_{idx}")
+    builder.adjust(1)
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"scope_page_{page - 1}"))
+    if pages > 1:
+        navigation.append(types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="scope_noop"))
+    if page < pages - 1:
+        navigation.append(types.InlineKeyboardButton(text="➡️", callback_data=f"scope_page_{page + 1}"))
+    if navigation:
+        builder.row(*navigation)
+    return builder.as_markup()
+
+@dp.callback_query(F.data.startswith("scope_"))
+async def handle_scope(callback: types.CallbackQuery):
+    session = user_sessions.get(callback.from_user.id)
+    if not session or "scope_documents" not in session:
+        await callback.answer("❌ Сессия устарела. Выполните /scope ещё раз.")
+        return
+
+    choice = callback.data.split("_", 1)[1]
+    if choice == "noop":  # Номер страницы
+        await callback.answer()
+        return
+    if choice.startswith("page_"):
+        documents = processor.list_documents(session["faiss_indexes"])
+        titles = [documents.get(doc_id, doc_id) for doc_id in session["scope_documents"]]
+        await callback.message.edit_reply_markup(reply_markup=scope_keyboard(titles, int(choice[5:])))
+        await callback.answer()
+        return
+    if choice == "all":
+        session["scope"] = None
+        await callback.message.answer("✅ Поиск по всей категории")
+    else:
+        doc_id = session["scope_documents"][int(choice)]
+        session["scope"] = [doc_id]
+        title = processor.list_documents(session["faiss_indexes"]).get(doc_id, doc_id)
+        await callback.message.answer(f"✅ Поиск только в документе: {title}")
+    await callback.answer()
+
+# ---------------- Команда /status Готовность и кэш баз ----------------
+@dp.message(Command("status"))
+async def cmd_status(message: types.Message):
+    categories = "\n".join(
+        f"• {escape(name)}: {escape(str(value))}{' с' if isinstance(value, float) else ''}"
+        for name, value in startup_report["categories"].items()
+    ) or "—"
+    await message.answer(
+        f"{'✅ Готов' if startup_report['ready'] else '⏳ Идёт прогрев'}\n"
+        f"🔥 Прогрев модели: <code>{startup_report['embedding_warmup_s']}</code> с\n"
+        f"⏱ Всего: <code>{startup_report['total_s']}</code> с\n"
+        f"📦 Категории:\n{categories}\n"
+        f"🗄 Кэш баз: <code>{escape(str(index_cache.stats()))}</code>\n"
+        f"🧮 Батчи эмбеддингов: <code>{escape(str(processor.embedding_batcher.stats() if processor.embedding_batcher else '—'))}</code>\n"
+        f"🔎 Слои последнего поиска: <code>{escape(str(user_sessions.get(message.from_user.id, {}).get('search_layers') or '—'))}</code>",
+        parse_mode=ParseMode.HTML
+    )
+
 # ------------------------------- Команда /help -------------------------------
 @dp.message(Command("help"))
 async def help_command(message: types.Message):
@@ -353,12 +669,18 @@ async def handle_category(callback: types.CallbackQuery):
         user_id = callback.from_user.id
         category = callback.data.split("_", 1)[1]  # Исправлено разделение
 
+        # Предыдущая категория пользователя больше не нужна его сессии
+        index_cache.release(user_sessions.get(user_id, {}).get("cache_entry"))
+
         # Инициализация сессии
         user_sessions[user_id] = {
+            "cache_entry": None,  # Ссылка на запись общего кэша баз
             "faiss_indexes": [],  # Будет заполнено
+            "faiss_partitions": None,  # Индексы разделов text / table (CacheEntry.partitions)
             "query_prefix": "",
             "last_results": [],  # Важно: создаем ключ заранее
-            "current_category": ""
+            "current_category": "",
+            "scope": None  # doc_id документа для поиска по одному документу (/scope)
         }
 
         # Убедимся, что путь существует
@@ -370,31 +692,25 @@ async def handle_category(callback: types.CallbackQuery):
         # Показываем статус "Загрузка..."
         await callback.answer("⏳ Загрузка...")
 
-        # Асинхронная загрузка баз
-        faiss_indexes = []
-        faiss_paths = [d for d, _, files in os.walk(category_path) for file in files if file.endswith(".faiss")]
-
         # Прогресс-бар
         progress_msg = await callback.message.answer("🔄 Прогресс: 0%")
 
-        for idx, faiss_dir in enumerate(faiss_paths):
-            # Загрузка в отдельном потоке
-            load_result = await asyncio.to_thread(
-                processor.faiss_loader,
-                faiss_dir,
-                hybrid_mode=False
-            )
+        shown = {"percent": 0}
 
-            if load_result["success"]:
-                faiss_indexes.append(load_result["db"])
+        async def show_progress(share: float):
+            # Telegram отклоняет правку без изменений текста
+            if int(share * 100) != shown["percent"]:
+                shown["percent"] = int(share * 100)
+                await progress_msg.edit_text(f"🔄 Прогресс: {shown['percent']}%")
 
-            # Обновление прогресса
-            progress = (idx + 1) / len(faiss_paths) * 100
-            await progress_msg.edit_text(f"🔄 Прогресс: {int(progress)}%")
+        # Базы берутся из общего кэша, с диска - только если категорию ещё никто не загрузил
+        entry = await index_cache.acquire(category_path, progress=show_progress)
 
         # # Сохраняем результат
         user_sessions[user_id].update({
-            "faiss_indexes": faiss_indexes,
+            "cache_entry": entry,
+            "faiss_indexes": entry.indexes,
+            "faiss_partitions": entry.partitions,
             "query_prefix": "query: " if processor.db_metadata.get("is_e5_model", False) else "",
             "current_category": category
         })
@@ -425,10 +741,12 @@ async def handle_query(message: types.Message):
         print(session["query_prefix"] + message.text)
 
         # Выполняем поиск
-        raw_results = await layered_search(
+        raw_results, session["search_layers"] = await layered_search(
             query=session["query_prefix"] + message.text,
             indexes=session["faiss_indexes"],
-            search_function=processor.aformatted_scored_mrr_search_with_cosine_sorting
+            search_function=processor.aformatted_scored_mrr_search_with_cosine_sorting,
+            scope=session.get("scope"),
+            partitions=session.get("faiss_partitions")
         )
 
         pprint(raw_results)
@@ -560,26 +878,26 @@ async def handle_query(message: types.Message):
         print(f"ERROR: {str(e)}")
         traceback.print_exc()
 
-async def layered_search(query: str, indexes: List[Optional[FAISS]], search_function: Callable):
-    all_results = []
-    global filters
-    Config.TEXT_K = 6
-
-    for filter_config in filters:
-        search_args = {
-            "filter": {k: v for k, v in filter_config.items() if not k.startswith('_')},
-            **filter_config.get("_search_params", {})
-        }
-
-    chunk_results = await processor.multi_async_search(
+async def layered_search(query: str,
+                         indexes: List[Optional[FAISS]],
+                         search_function: Callable,
+                         scope: Optional[List[str]] = None,
+                         partitions: Optional[dict] = None):
+    """
+    Текстовый и табличный слои (filters) ищутся одновременно, итог собирается по квотам слоёв.
+    :param scope: Список doc_id, которыми ограничивается поиск (None - вся категория)
+    :param partitions: Разделы баз по element_type: слой ищется по своему разделу без фильтра по типу
+    :return: (результаты, {слой: {"ms", "found", "kept"}})
+    """
+    return await processor.alayered_search(
         query=query,
         indexes=indexes,
         search_function=search_function,
-        **search_args
+        layers=filters,
+        total_k=Config.GENERATION_K,
+        extra_filter={"doc_id": scope} if scope else None,
+        partitions=partitions
     )
-    all_results.extend(chunk_results)
-
-    return all_results
 
 # Обработчик оценки пользователя
 @dp.callback_query(F.data.startswith("rate_"))
@@ -673,6 +991,14 @@ async def handle_article_selection(callback: types.CallbackQuery):
 
 async def assemble_full_content(main_chunk: dict, faiss_indexes: list) -> str:
     """Сборка полного контента из связанных чанков"""
+    # Статья по group_id: куски берутся по chunk_index базы
+    group_id = main_chunk["metadata"].get("group_id")
+    if group_id:
+        article = processor.find_article(group_id, faiss_indexes)
+        if article:
+            return article["text"]
+
+    # Чанки без group_id: обход связей linked
     chunks = []
     visited = set()
     queue = [main_chunk["metadata"]["chunk_id"]]
@@ -682,16 +1008,8 @@ async def assemble_full_content(main_chunk: dict, faiss_indexes: list) -> str:
         if chunk_id in visited:
             continue
 
-        # Поиск чанка во всех индексах
-        chunk = None
-        for index in faiss_indexes:
-            chunk = next(
-                (doc for doc in index.docstore._dict.values()
-                 if doc.metadata["chunk_id"] == chunk_id),
-                None
-            )
-            if chunk:
-                break
+        # Поиск чанка во всех индексах (по chunk_index каждой базы)
+        chunk = processor.find_chunk(chunk_id, faiss_indexes)
 
         if chunk:
             chunks.append(chunk)
@@ -19,19 +19,43 @@ import tiktoken
 # from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.docstore.base import Docstore
+import faiss
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.embeddings import Embeddings
 
 import functools
 import asyncio
+import heapq
+from collections import OrderedDict
+import math
+import threading
+from contextlib import contextmanager
+import atexit
+import weakref
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессной блокировки кэша эмбеддингов нет
+    fcntl = None
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from sentence_transformers import SentenceTransformer
 
 import re                 # работа с регулярными выражениями
+import unicodedata
+import zipfile
+import pickle
+import sqlite3
+from collections.abc import Mapping
+from xml.etree import ElementTree
 import requests
 from dotenv import load_dotenv
 import time
 # from langchain_huggingface import HuggingFaceEmbeddings
-from typing import List, Any, Dict, Generator, Optional, Tuple, Callable
+from typing import List, Any, Dict, Generator, Iterable, Optional, Tuple, Callable, Union
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"  # Пространство имён WordprocessingML
 
 
 class RAG(ABC):
@@ -174,6 +198,777 @@ class MetaCompatibilityError(Exception):
     def __init__(self, message="Метаданные несовместимы."):
         super().__init__(message)
 
+class EmbeddingCache:
+    """
+    Персистентный кэш эмбеддингов на диске, общий для потоков и процессов (бот и сборка баз).
+    Для каждой пары (модель, нормализация) заводится своя подпапка, ключ внутри неё - SHA-1 текста.
+    Векторы лежат в memory-mapped массиве float32 (vectors.f32), рядом в slots.bin - ключ и метка
+    последнего использования каждой строки: это и есть индекс кэша, отдельного списка ключей нет.
+    Строки занимаются под межпроцессной блокировкой папки (fcntl), причём свободные строки берутся
+    из slots.bin на диске, а не из памяти процесса. Прочитанный вектор отдаётся, только если ключ его
+    строки совпадает до и после чтения - строку, которую занял другой процесс, этот процесс видит как промах.
+    При переполнении вытесняются давно не использованные записи (LRU), сразу EVICT_SHARE ёмкости;
+    ключи вытесненных строк стираются на диске до того, как строки перезаписываются.
+    Экземпляр один на папку в процессе - см. open.
+    """
+    FLUSH_EVERY = 4096
+    FLUSH_SECONDS = 30.0
+    EVICT_SHARE = 1 / 64
+    SLOT_DTYPE = np.dtype([("key", "S40"), ("stamp", "<f8")])  # Ключ - SHA-1 в hex: в нём нет нулевых байтов
+
+    _instances = weakref.WeakValueDictionary()  # (папка, ёмкость) -> открытый кэш
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, cache_dir: str, model_name: str, normalized: bool, max_entries: int = 100_000) -> "EmbeddingCache":
+        """Кэш папки: уже открытый в этом процессе экземпляр или новый"""
+        safe_name = re.sub(r'[^\w.-]+', '_', model_name)
+        folder = os.path.abspath(os.path.join(cache_dir, f"{safe_name}-{'norm' if normalized else 'raw'}"))
+        with cls._instances_lock:
+            cache = cls._instances.get((folder, max_entries))
+            if cache is None:
+                cache = cls(folder, max_entries)
+                cls._instances[(folder, max_entries)] = cache
+            return cache
+
+    def __init__(self, folder: str, max_entries: int = 100_000):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.dimension = None
+        self.entries = {}  # ключ -> номер строки, по последнему прочитанному slots.bin
+        self.generation = -1  # Номер версии slots.bin, по которому построен entries
+        self.vectors = None
+        self.slots = None
+        self.counter = None  # generation.i64: увеличивается при каждом изменении slots.bin
+        self.hits = 0
+        self.misses = 0
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock_file = open(os.path.join(self.folder, "lock"), "a+b")
+        with self._locked():
+            self._open_files()
+        atexit.register(EmbeddingCache._flush_at_exit, weakref.ref(self))
+
+    @staticmethod
+    def _flush_at_exit(cache_ref):
+        cache = cache_ref()
+        if cache is not None and cache.unflushed:
+            cache.flush()
+
+    @staticmethod
+    def text_key(text: str) -> bytes:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest().encode("ascii")
+
+    @contextmanager
+    def _locked(self):
+        """Межпроцессная блокировка папки кэша (без fcntl - только блокировка потоков)"""
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _open_files(self) -> bool:
+        """Открывает файлы кэша, если их создал этот или другой процесс. Вызывается под _locked"""
+        try:
+            with open(os.path.join(self.folder, "cache.json"), "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        # Кэш другого размера пересоздаётся с нуля (см. _create_files)
+        if info.get("capacity") != self.max_entries or not info.get("dimension"):
+            return False
+        self.dimension = info["dimension"]
+        self.vectors = np.memmap(os.path.join(self.folder, "vectors.f32"), dtype=np.float32, mode="r+",
+                                 shape=(self.max_entries, self.dimension))
+        self.slots = np.memmap(os.path.join(self.folder, "slots.bin"), dtype=self.SLOT_DTYPE, mode="r+",
+                               shape=(self.max_entries,))
+        self.counter = np.memmap(os.path.join(self.folder, "generation.i64"), dtype=np.int64, mode="r+", shape=(1,))
+        self.generation = -1
+        self._refresh()
+        return True
+
+    def _create_files(self, dimension: int):
+        """
+        Создаёт пустой кэш. Файлы пишутся под временными именами и подменяются целиком (os.replace):
+        процессы, у которых открыт старый кэш, не получают SIGBUS от усечённого файла. Вызывается под _locked
+        """
+        for name, dtype, shape in [("vectors.f32", np.float32, (self.max_entries, dimension)),
+                                   ("slots.bin", self.SLOT_DTYPE, (self.max_entries,)),
+                                   ("generation.i64", np.int64, (1,))]:
+            tmp_path = os.path.join(self.folder, name + ".tmp")
+            np.memmap(tmp_path, dtype=dtype, mode="w+", shape=shape).flush()
+            os.replace(tmp_path, os.path.join(self.folder, name))
+        tmp_path = os.path.join(self.folder, "cache.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dimension": dimension, "capacity": self.max_entries}, f)
+        os.replace(tmp_path, os.path.join(self.folder, "cache.json"))
+        self._open_files()
+
+    def _refresh(self):
+        """Перестраивает entries, если slots.bin изменился (в том числе другим процессом)"""
+        if self.counter is None or int(self.counter[0]) == self.generation:
+            return
+        self.generation = int(self.counter[0])
+        keys = self.slots["key"]
+        used = np.flatnonzero(keys != b"")
+        self.entries = dict(zip(keys[used].tolist(), used.tolist()))
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Возвращает векторы из кэша, None - для отсутствующих текстов"""
+        out = []
+        with self._lock:
+            self._refresh()
+            now = time.time()
+            for text in texts:
+                key = self.text_key(text)
+                slot = self.entries.get(key)
+                vector = None
+                if slot is not None and self.slots["key"][slot] == key:
+                    vector = self.vectors[slot].tolist()
+                    # Строку могли занять заново, пока вектор читался
+                    if self.slots["key"][slot] != key:
+                        vector = None
+                if vector is None:
+                    self.misses += 1
+                    out.append(None)
+                    continue
+                self.hits += 1
+                self.slots["stamp"][slot] = now
+                out.append(vector)
+        return out
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        """Добавляет векторы в кэш, вытесняя самые старые записи при нехватке места"""
+        if not texts:
+            return
+        with self._lock, self._locked():
+            if self.vectors is None and not self._open_files():
+                self._create_files(len(vectors[0]))
+            self._refresh()
+
+            new_items = {}
+            for text, vector in zip(texts, vectors):
+                new_items[self.text_key(text)] = vector
+            new_items = {key: vector for key, vector in new_items.items()
+                         if key not in self.entries or self.slots["key"][self.entries[key]] != key}
+            if len(new_items) > self.max_entries:
+                new_items = dict(list(new_items.items())[-self.max_entries:])
+            if not new_items:
+                return
+
+            free = np.flatnonzero(self.slots["key"] == b"")
+            shortage = len(new_items) - len(free)
+            if shortage > 0:
+                # Вытесняем с запасом, чтобы slots.bin переписывался не на каждый промах
+                evict = min(max(shortage, int(self.max_entries * self.EVICT_SHARE)), self.max_entries)
+                used = np.flatnonzero(self.slots["key"] != b"")
+                oldest = used[np.argpartition(self.slots["stamp"][used], evict - 1)[:evict]] \
+                    if evict < len(used) else used
+                # Ключи вытесненных строк стираются на диске до того, как строки будут перезаписаны
+                for key in self.slots["key"][oldest].tolist():
+                    self.entries.pop(key, None)
+                self.slots["key"][oldest] = b""
+                self.slots.flush()
+                free = np.concatenate([free, oldest])
+
+            slots = np.sort(free)[:len(new_items)]
+            self.vectors[slots] = np.asarray(list(new_items.values()), dtype=np.float32)
+            # Векторы на диск раньше ключей: ключ не должен ссылаться на строку, которой ещё нет на диске
+            self.vectors.flush()
+            self.slots["stamp"][slots] = time.time()
+            self.slots["key"][slots] = list(new_items)
+            self.entries.update(zip(new_items, slots.tolist()))
+            self.counter[0] += 1
+            self.generation = int(self.counter[0])
+            self.unflushed += len(new_items)
+
+    def maybe_flush(self):
+        """flush, если накопилось FLUSH_EVERY новых записей или прошло FLUSH_SECONDS с прошлого сброса"""
+        if self.unflushed and (self.unflushed >= self.FLUSH_EVERY
+                               or time.monotonic() - self.last_flush >= self.FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """Сбрасывает векторы и строки кэша на диск"""
+        with self._lock:
+            if self.vectors is None:
+                return
+            self.vectors.flush()
+            self.slots.flush()
+            self.counter.flush()
+            self.unflushed = 0
+            self.last_flush = time.monotonic()
+
+
+class CachedEmbeddings(Embeddings):
+    """Обёртка над моделью эмбеддингов: сначала ищет векторы в EmbeddingCache, модель считает только промахи"""
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache):
+        self.base = base
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.cache.get_many(texts)
+        missing = [n for n, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.base.embed_documents([texts[n] for n in missing])
+            for n, vector in zip(missing, computed):
+                vectors[n] = list(vector)
+            self.cache.put_many([texts[n] for n in missing], [vectors[n] for n in missing])
+            self.cache.maybe_flush()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.cache.get_many([text])[0]
+        if vector is None:
+            vector = list(self.base.embed_query(text))
+            self.cache.put_many([text], [vector])
+            self.cache.maybe_flush()
+        return vector
+
+
+class QueryEmbeddingCache:
+    """
+    Кэш векторов поисковых запросов в памяти: не более max_entries записей (LRU), запись живёт ttl секунд.
+    Ключ - нормализованный текст запроса (Unicode NFC, пробелы схлопнуты). Кэш привязан к объекту
+    модели эмбеддингов и очищается при её смене.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # ключ -> (время записи, вектор)
+        self.owner = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    def bind(self, embeddings: Optional[Embeddings]):
+        """Сбрасывает кэш, если векторы считала другая модель"""
+        with self._lock:
+            if self.owner is not embeddings:
+                self.entries.clear()
+                self.owner = embeddings
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            item = self.entries.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                if item is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, vector: List[float]):
+        with self._lock:
+            self.entries[key] = (time.monotonic(), vector)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class EmbeddingBatcher:
+    """
+    Асинхронная очередь к модели эмбеддингов. Запросы, пришедшие в течение window секунд (или пока
+    не наберётся max_batch), считаются одним вызовом embed_documents - одним батчем модели вместо
+    множества отдельных прогонов. Каждый запрос получает свой вектор через future.
+    Метрики (stats): число батчей и запросов, средняя заполненность батча, задержка в очереди.
+    """
+
+    def __init__(self, embeddings: Embeddings, window: float = 0.005, max_batch: int = 32):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = []  # (текст, future, время постановки в очередь)
+        self._timer = None
+        self.batches = 0
+        self.requests = 0
+        self.fill_total = 0.0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((text, future, time.perf_counter()))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list):
+        started = time.perf_counter()
+        delays = [started - queued for _, _, queued in batch]
+        self.batches += 1
+        self.requests += len(batch)
+        self.fill_total += len(batch) / self.max_batch
+        self.delay_total += sum(delays)
+        self.delay_max = max(self.delay_max, *delays)
+
+        texts = list(dict.fromkeys(text for text, _, _ in batch))  # Одинаковые тексты считаются один раз
+        try:
+            vectors = dict(zip(texts, await asyncio.to_thread(self.embeddings.embed_documents, texts)))
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future, _ in batch:
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "fill_rate": round(self.fill_total / self.batches, 3) if self.batches else None,
+            "queue_delay_ms": round(1000 * self.delay_total / self.requests, 2) if self.requests else None,
+            "queue_delay_max_ms": round(1000 * self.delay_max, 2),
+            "queued": len(self.pending)
+        }
+
+
+class ChunkStore(Docstore):
+    """
+    Хранилище чанков FAISS-базы в SQLite (chunks.sqlite) - замена index.pkl.
+    Таблица chunks: номер вектора в индексе, id документа, текст и метаданные (JSON), а также
+    индексированные столбцы chunk_id, doc_id, group_id и название документа - по ним работает ChunkStoreIndex.
+    Файл открывается только для чтения с отображением в память, документы читаются по id
+    при обращении, последние прочитанные кэшируются (LRU). Загрузка не зависит от размера базы.
+    Через id_map хранилище служит и отображением index_to_docstore_id.
+    """
+    FILE_NAME = "chunks.sqlite"
+    MMAP_SIZE = 1 << 30
+
+    def __init__(self, path: str, cache_size: int = 4096):
+        self.path = path
+        self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+        self._lock = threading.Lock()
+        self._size = self._query("SELECT COUNT(*) FROM chunks")[0][0]
+        # Хранилища, записанные до появления столбцов chunk_id / doc_id / group_id, их не имеют
+        self.has_keys = "chunk_id" in {row[1] for row in self._query("PRAGMA table_info(chunks)")}
+        self._fetch = functools.lru_cache(maxsize=cache_size)(self._fetch)
+        self.id_map = ChunkIdMap(self)
+
+    def _query(self, sql: str, args: tuple = ()) -> list:
+        # Соединение одно на хранилище, а поиск бота идёт из пула потоков
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    @staticmethod
+    def _to_doc(doc_id: str, content: str, metadata: str) -> LangDoc:
+        return LangDoc(id=doc_id, page_content=content, metadata=json.loads(metadata))
+
+    def _fetch(self, doc_id: str) -> Optional[LangDoc]:
+        rows = self._query("SELECT id, content, metadata FROM chunks WHERE id = ?", (doc_id,))
+        return self._to_doc(*rows[0]) if rows else None
+
+    def search(self, search: str) -> LangDoc | str:
+        """Документ по id. Как и в InMemoryDocstore, для неизвестного id возвращается строка с ошибкой"""
+        doc = self._fetch(search)
+        return doc if doc is not None else f"ID {search} not found."
+
+    def id_at(self, position: int) -> str:
+        rows = self._query("SELECT id FROM chunks WHERE pos = ?", (position,))
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def iter_ids(self) -> Generator[Tuple[int, str], None, None]:
+        """Пары (номер вектора, id) по порядку номеров"""
+        yield from self._query("SELECT pos, id FROM chunks ORDER BY pos")
+
+    def iter_documents(self, batch_size: int = 1000) -> Generator[Tuple[int, LangDoc], None, None]:
+        """Пары (номер вектора, документ) по порядку номеров, читаются пакетами, мимо кэша"""
+        last = -1
+        while True:
+            rows = self._query("SELECT pos, id, content, metadata FROM chunks WHERE pos > ? ORDER BY pos LIMIT ?",
+                               (last, batch_size))
+            if not rows:
+                return
+            for pos, doc_id, content, metadata in rows:
+                yield pos, self._to_doc(doc_id, content, metadata)
+            last = rows[-1][0]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def close(self):
+        self._conn.close()
+
+    @classmethod
+    def write(cls, path: str, documents: Dict[str, LangDoc], index_to_docstore_id: Dict[int, str]):
+        """Записывает хранилище атомарно: во временный файл, затем замена"""
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("CREATE TABLE chunks (pos INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, "
+                         "content TEXT NOT NULL, metadata TEXT NOT NULL, "
+                         "chunk_id TEXT, doc_id TEXT, group_id TEXT, title TEXT)")
+            conn.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((pos, doc_id, documents[doc_id].page_content,
+                  json.dumps(documents[doc_id].metadata, ensure_ascii=False, default=str),
+                  *cls._key_columns(documents[doc_id].metadata))
+                 for pos, doc_id in sorted(index_to_docstore_id.items()))
+            )
+            for column in ("chunk_id", "doc_id", "group_id"):
+                conn.execute(f"CREATE INDEX chunks_{column} ON chunks ({column})")
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+
+
+    @staticmethod
+    def _key_columns(metadata: dict) -> tuple:
+        """chunk_id, doc_id, group_id и название - как их учитывает ChunkIndex.build (без chunk_id чанк не в индексе)"""
+        if metadata.get("chunk_id") is None:
+            return None, None, None, None
+        text = lambda value: None if value is None else str(value)
+        return (text(metadata["chunk_id"]), text(metadata.get("doc_id")), text(metadata.get("group_id")),
+                metadata.get("_title") or None)
+
+
+class ChunkIdMap(Mapping):
+    """index_to_docstore_id для FAISS поверх ChunkStore: номер вектора -> id, без загрузки всех id в память"""
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+
+    def __getitem__(self, position: int) -> str:
+        return self.store.id_at(int(position))
+
+    def __iter__(self):
+        return iter(range(len(self.store)))
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def items(self):
+        return self.store.iter_ids()
+
+    def values(self):
+        return (doc_id for _, doc_id in self.store.iter_ids())
+
+
+class ChunkColumnMap(Mapping):
+    """
+    Отображение по индексированному столбцу таблицы chunks (ChunkStore) для ChunkStoreIndex:
+    значение "id" - id документа в docstore, "chunk_ids" - chunk_id строк в порядке индекса,
+    "title" - первое непустое название документа. Каждое обращение - запрос по индексу SQLite.
+    """
+
+    def __init__(self, store: ChunkStore, column: str, value: str):
+        self.store = store
+        self.column = column
+        self.value = value
+
+    def __getitem__(self, key):
+        if self.value == "id":
+            rows = self.store._query(f"SELECT id FROM chunks WHERE {self.column} = ? LIMIT 1", (str(key),))
+            if rows:
+                return rows[0][0]
+        elif self.value == "chunk_ids":
+            rows = self.store._query(f"SELECT chunk_id FROM chunks WHERE {self.column} = ? AND chunk_id IS NOT NULL "
+                                     f"ORDER BY pos", (str(key),))
+            if rows:
+                return [row[0] for row in rows]
+        else:
+            rows = self.store._query(f"SELECT title FROM chunks WHERE {self.column} = ? AND title IS NOT NULL "
+                                     f"ORDER BY pos LIMIT 1", (str(key),))
+            if rows:
+                return rows[0][0]
+        raise KeyError(key)
+
+    def __iter__(self):
+        extra = " AND title IS NOT NULL" if self.value == "title" else ""
+        return (row[0] for row in self.store._query(
+            f"SELECT {self.column} FROM chunks WHERE {self.column} IS NOT NULL AND chunk_id IS NOT NULL{extra} "
+            f"GROUP BY {self.column} ORDER BY MIN(pos)"))
+
+    def __len__(self) -> int:
+        extra = " AND title IS NOT NULL" if self.value == "title" else ""
+        return self.store._query(f"SELECT COUNT(DISTINCT {self.column}) FROM chunks "
+                                 f"WHERE {self.column} IS NOT NULL AND chunk_id IS NOT NULL{extra}")[0][0]
+
+
+class ChunkStoreIndex:
+    """
+    ChunkIndex базы с хранилищем SQLite: те же chunks / docs / titles / groups, но поверх индексированных
+    столбцов chunks.sqlite. Ничего не читается при загрузке, память растёт только с прочитанными строками.
+    """
+
+    def __init__(self, store: ChunkStore):
+        self.chunks = ChunkColumnMap(store, "chunk_id", "id")
+        self.docs = ChunkColumnMap(store, "doc_id", "chunk_ids")
+        self.titles = ChunkColumnMap(store, "doc_id", "title")
+        self.groups = ChunkColumnMap(store, "group_id", "chunk_ids")
+
+
+class ChunkIndex:
+    """
+    Хэш-индекс базы: chunk_id -> id документа в docstore, doc_id -> chunk_id его чанков (в порядке индекса),
+    doc_id -> название документа (_title) и group_id -> chunk_id кусков статьи (текст статьи собирается
+    из docstore при запросе, см. DBConstructor.find_article).
+    Строится при записи базы с хранилищем pickle, хранится рядом с ней в chunk_index.json и загружается
+    вместе с ней, поэтому поиск чанка и его соседей не требует обхода docstore. Базам с хранилищем SQLite
+    файл не нужен - см. ChunkStoreIndex.
+    """
+    FILE_NAME = "chunk_index.json"
+
+    def __init__(self,
+                 chunks: Optional[Dict[str, str]] = None,
+                 docs: Optional[Dict[str, List[str]]] = None,
+                 titles: Optional[Dict[str, str]] = None,
+                 groups: Optional[Dict[str, List[str]]] = None):
+        self.chunks = chunks or {}
+        self.docs = docs or {}
+        self.titles = titles or {}
+        self.groups = groups or {}
+
+    @classmethod
+    def build(cls, documents: Iterable[Tuple[str, LangDoc]]) -> "ChunkIndex":
+        """:param documents: Пары (id в docstore, документ) в порядке номеров векторов"""
+        index = cls()
+        for docstore_id, doc in documents:
+            chunk_id = doc.metadata.get("chunk_id")
+            if chunk_id is None:
+                continue
+            index.chunks[chunk_id] = docstore_id
+            if doc.metadata.get("group_id") is not None:
+                index.groups.setdefault(doc.metadata["group_id"], []).append(chunk_id)
+            if "doc_id" in doc.metadata:
+                doc_id = str(doc.metadata["doc_id"])
+                index.docs.setdefault(doc_id, []).append(chunk_id)
+                if doc.metadata.get("_title"):
+                    index.titles.setdefault(doc_id, doc.metadata["_title"])
+        return index
+
+    def save(self, folder: str):
+        with open(os.path.join(folder, self.FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump({"chunks": self.chunks, "docs": self.docs, "titles": self.titles, "groups": self.groups},
+                      f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, folder: str) -> Optional["ChunkIndex"]:
+        try:
+            with open(os.path.join(folder, cls.FILE_NAME), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if "groups" not in data:
+            return None  # Индекс старого формата - строится заново по docstore
+        return cls(data.get("chunks"), data.get("docs"), data.get("titles"), data["groups"])
+
+
+class SplitterEngine:
+    """
+    Переиспользуемый аналог RecursiveCharacterTextSplitter с предкомпилированными разделителями.
+    Повторяет алгоритм langchain_text_splitters один в один, поэтому чанки совпадают с прежними.
+    Экземпляры кэшируются по набору параметров в get_splitter_engine.
+    """
+
+    def __init__(self,
+                 chunk_size: int,
+                 separators: Tuple[str, ...] = ('\n\n', '\n', ' ', ''),
+                 is_separator_regex: bool = False,
+                 chunk_overlap: int = 0,
+                 keep_separator: bool | str = True,
+                 strip_whitespace: bool = True,
+                 length_function: Callable[[str], int] = len):
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"Перекрытие чанков ({chunk_overlap}) больше размера чанка ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.keep_separator = keep_separator
+        self.strip_whitespace = strip_whitespace
+        self.length_function = length_function
+        self.separators = list(separators)
+
+        # Для каждого разделителя: шаблон поиска и шаблон разбиения (со скобками, если разделитель сохраняется)
+        self._search = []
+        self._split = []
+        for sep in self.separators:
+            pattern = sep if is_separator_regex else re.escape(sep)
+            self._search.append(re.compile(pattern) if sep else None)
+            if not pattern:
+                self._split.append(None)
+            else:
+                self._split.append(re.compile(f"({pattern})" if keep_separator else pattern))
+
+    def split_text(self, text: str) -> List[str]:
+        return self._split_text(text, 0)
+
+    def split_many(self, texts: List[str]) -> List[List[str]]:
+        """Разбивает список текстов за один вызов"""
+        return [self._split_text(text, 0) for text in texts]
+
+    def _split_text(self, text: str, start: int) -> List[str]:
+        final_chunks = []
+        # Выбор разделителя: первый из оставшихся, который встречается в тексте
+        sep_index = len(self.separators) - 1
+        next_start = None
+        for i in range(start, len(self.separators)):
+            if self._search[i] is None:
+                sep_index = i
+                break
+            if self._search[i].search(text):
+                sep_index = i
+                next_start = i + 1 if i + 1 < len(self.separators) else None
+                break
+
+        splits = self._split_with_regex(text, sep_index)
+
+        # Слияние мелких кусков и рекурсивное разбиение крупных
+        good_splits = []
+        separator = "" if self.keep_separator else self.separators[sep_index]
+        for piece in splits:
+            if self.length_function(piece) < self.chunk_size:
+                good_splits.append(piece)
+            else:
+                if good_splits:
+                    final_chunks.extend(self._merge_splits(good_splits, separator))
+                    good_splits = []
+                if next_start is None:
+                    final_chunks.append(piece)
+                else:
+                    final_chunks.extend(self._split_text(piece, next_start))
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits, separator))
+        return final_chunks
+
+    def _split_with_regex(self, text: str, sep_index: int) -> List[str]:
+        pattern = self._split[sep_index]
+        if pattern is None:
+            splits = list(text)
+        elif self.keep_separator:
+            parts = pattern.split(text)
+            if self.keep_separator == "end":
+                splits = [parts[i] + parts[i + 1] for i in range(0, len(parts) - 1, 2)]
+            else:
+                splits = [parts[i] + parts[i + 1] for i in range(1, len(parts), 2)]
+            if len(parts) % 2 == 0:
+                splits += parts[-1:]
+            splits = splits + [parts[-1]] if self.keep_separator == "end" else [parts[0]] + splits
+        else:
+            splits = pattern.split(text)
+        return [piece for piece in splits if piece != ""]
+
+    def _join_docs(self, docs: List[str], separator: str) -> Optional[str]:
+        text = separator.join(docs)
+        if self.strip_whitespace:
+            text = text.strip()
+        return text or None
+
+    def _merge_splits(self, splits: List[str], separator: str) -> List[str]:
+        separator_len = self.length_function(separator)
+        docs = []
+        current_doc = []
+        head = 0  # Начало текущего чанка в current_doc (вместо срезов current_doc[1:])
+        total = 0
+        for piece in splits:
+            piece_len = self.length_function(piece)
+            count = len(current_doc) - head
+            if total + piece_len + (separator_len if count > 0 else 0) > self.chunk_size:
+                if count > 0:
+                    doc = self._join_docs(current_doc[head:], separator)
+                    if doc is not None:
+                        docs.append(doc)
+                    while total > self.chunk_overlap or (
+                            total + piece_len + (separator_len if len(current_doc) - head > 0 else 0)
+                            > self.chunk_size and total > 0):
+                        total -= self.length_function(current_doc[head]) + (
+                            separator_len if len(current_doc) - head > 1 else 0)
+                        head += 1
+            current_doc.append(piece)
+            total += piece_len + (separator_len if len(current_doc) - head > 1 else 0)
+        doc = self._join_docs(current_doc[head:], separator)
+        if doc is not None:
+            docs.append(doc)
+        return docs
+
+
+@functools.lru_cache(maxsize=None)
+def get_tiktoken_encoding(encoding_name: str) -> tiktoken.Encoding:
+    """Кодировка tiktoken, загружаемая один раз на процесс"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=None)
+def token_length_function(encoding_name: str) -> Callable[[str], int]:
+    """
+    Функция длины в токенах для сплиттера. Для каждой кодировки возвращается один и тот же объект,
+    поэтому get_splitter_engine переиспользует сплиттер.
+    """
+    encoding = get_tiktoken_encoding(encoding_name)
+
+    def length(text: str) -> int:
+        return len(encoding.encode_ordinary(text))
+
+    return length
+
+
+@functools.lru_cache(maxsize=None)
+def get_hf_tokenizer(model_name: str):
+    """Токенизатор модели эмбеддингов HuggingFace (без весов модели), загружаемый один раз на процесс"""
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.model_max_length = int(1e30)  # Только подсчёт длины: без предупреждений о длинных текстах
+    return tokenizer
+
+
+@functools.lru_cache(maxsize=None)
+def hf_token_length_function(model_name: str) -> Callable[[str], int]:
+    """
+    Функция длины в токенах самой модели эмбеддингов (без служебных токенов [CLS] / [SEP]).
+    Как и token_length_function, для каждой модели возвращает один и тот же объект.
+    """
+    tokenizer = get_hf_tokenizer(model_name)
+
+    def length(text: str) -> int:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    return length
+
+
+@functools.lru_cache(maxsize=32)
+def get_splitter_engine(chunk_size: int,
+                        separators: Tuple[str, ...] = ('\n\n', '\n', ' ', ''),
+                        is_separator_regex: bool = False,
+                        chunk_overlap: int = 0,
+                        keep_separator: bool | str = True,
+                        strip_whitespace: bool = True,
+                        length_function: Callable[[str], int] = len) -> SplitterEngine:
+    """Возвращает закэшированный SplitterEngine для набора параметров"""
+    return SplitterEngine(chunk_size, separators, is_separator_regex, chunk_overlap, keep_separator,
+                          strip_whitespace, length_function)
+
+
 class DBConstructor(RAGProcessor):
     def __init__(self, embeddings=None):
         super().__init__()
@@ -184,6 +979,21 @@ class DBConstructor(RAGProcessor):
         self.embeddings = embeddings
         self.db_metadata = None
         self.chunk_size = 700
+        self.chunk_unit = "chars"  # Единица chunk_size: "chars" (символы) или "tokens" (токены модели эмбеддингов)
+        self.token_encoding = None  # Кодировка tiktoken для режима токенов (None - токенизатор модели), см. token_counter
+        self.pdf_pages_per_job = 20  # Страниц PDF на один вызов camelot
+        self.pdf_workers = None  # Процессов для таблиц PDF (None - по числу ядер)
+        self.index_spec = None  # Тип индекса FAISS для новых баз (None - плоский), см. _resolve_index_spec
+        self.docstore_format = "pickle"  # Хранилище чанков новых баз: "pickle" (index.pkl) или "sqlite" (ChunkStore)
+        self.mmap_load = False  # Режим загрузки новых баз по умолчанию (metadata.json "mmap"), см. _read_faiss_index
+        self.partition_bases = False  # Разделы text_db / table_db у сводных баз (merge_databases), см. _write_partitions
+        self.query_cache = QueryEmbeddingCache()  # Векторы недавних поисковых запросов, см. embed_query
+        self._query_inflight = {}  # Запросы, которые модель считает прямо сейчас (aembed_query)
+        self.embed_batch_window = 0.005  # Сколько секунд aembed_query собирает запросы в один батч
+        self.embed_batch_size = 32  # Максимальный размер батча aembed_query
+        self.embedding_batcher = None  # EmbeddingBatcher для текущей модели, см. aembed_query
+        self._shard_searchers = OrderedDict()  # faiss.IndexShards по наборам индексов, см. _shard_searcher
+        self.docx_backend = "dom"  # Парсер DOCX: "dom" (python-docx) или "stream" (потоковый разбор XML)
         self.source_chunks = None
         self.num_tokens = 0
         self.summary = None
@@ -191,6 +1001,8 @@ class DBConstructor(RAGProcessor):
         self.answer = None
         self.unprocessed_text = None
         self.processed_text = None
+        self.embedding_cache_dir = None  # Папка персистентного кэша эмбеддингов (None - кэш выключен)
+        self.embedding_cache_size = 100_000
 
     @staticmethod
     def async_wrapper(method):
@@ -257,6 +1069,9 @@ class DBConstructor(RAGProcessor):
 # --------------------------------------------------------
 # Парсинг docx
     def _parse_docx(self, file_path: str) -> list:
+        if self.docx_backend == "stream":
+            return self._parse_docx_stream(file_path)
+
         doc = Docx(file_path)
         raw_chunks = []
         current_chunk = []
@@ -280,7 +1095,7 @@ class DBConstructor(RAGProcessor):
                 # Пропускаем заголовок документа
                 if p.style.name == 'Heading 1':
                     continue
-                elements.append(('p', DocxParagraph(elem, doc)))
+                elements.append(('p', p))
             elif elem.tag.endswith('tbl'):
                 elements.append(('tbl', DocxTable(elem, doc)))
 
@@ -329,6 +1144,10 @@ class DBConstructor(RAGProcessor):
                 "_title": title
             })
 
+        return self._raw_chunks_to_docs(raw_chunks, doc_id)
+
+    @staticmethod
+    def _raw_chunks_to_docs(raw_chunks: List[dict], doc_id: str) -> List[LangDoc]:
         return [LangDoc(page_content=chunk["content"],
                         metadata={
                             "doc_id": doc_id,
@@ -336,6 +1155,177 @@ class DBConstructor(RAGProcessor):
                             "element_type": chunk["type"]
                         }) for chunk in raw_chunks]
 
+    def _parse_docx_stream(self, file_path: str) -> list:
+        """
+        Потоковый парсер DOCX: один проход по word/document.xml инкрементальным XML-парсером.
+        Результат совпадает с _parse_docx на python-docx. Вместо повторного просмотра элементов
+        в _is_table_context подряд идущие непустые параграфы откладываются до первого
+        пустого параграфа или таблицы, после чего решается, заголовок ли это таблицы.
+        Разобранные элементы сразу удаляются из дерева, поэтому память не растёт с размером документа.
+        """
+        raw_chunks = []
+        current_chunk = []
+        pending = []  # Непустые параграфы, для которых ещё не известно, предшествуют ли они таблице
+        in_table_group = False
+        table_head = ""
+        title = None
+        doc_id = hashlib.md5(file_path.encode()).hexdigest()[:8]
+
+        def flush_chunk():
+            if current_chunk:
+                raw_chunks.append({"content": "\n".join(current_chunk),
+                                   "type": "table" if in_table_group else "text"})
+
+        with zipfile.ZipFile(file_path) as archive:
+            style_names, default_style = self._docx_paragraph_styles(archive)
+
+            with archive.open("word/document.xml") as xml_file:
+                depth = 0
+                body = None
+                prev_row = {}
+                for event, elem in ElementTree.iterparse(xml_file, events=("start", "end")):
+                    if event == "start":
+                        depth += 1
+                        if depth == 2 and elem.tag == _W + "body":
+                            body = elem
+                        continue
+
+                    depth -= 1
+                    if depth != 2 or body is None:
+                        continue
+
+                    # Элемент верхнего уровня тела документа
+                    if elem.tag == _W + "p":
+                        p_style = elem.find(f"{_W}pPr/{_W}pStyle")
+                        style_name = style_names.get(p_style.get(_W + "val"), default_style) \
+                            if p_style is not None else default_style
+                        text = self._xml_paragraph_text(elem)
+
+                        if style_name == 'Heading 1':
+                            if title is None:
+                                title = text.strip()
+                        else:
+                            text = text.strip()
+                            if text:
+                                pending.append(text)
+                            else:
+                                # Отложенные параграфы не были заголовком таблицы
+                                current_chunk.extend(pending)
+                                pending = []
+                                flush_chunk()
+                                current_chunk = []
+                                in_table_group = False
+
+                    elif elem.tag == _W + "tbl":
+                        # Отложенные параграфы - заголовок таблицы, в заголовок попадает последний из них
+                        if pending:
+                            table_head = pending[-1]
+                            in_table_group = True
+                            pending = []
+
+                        rows = []
+                        prev_row = {}
+                        for tr in elem.findall(_W + "tr"):
+                            row, prev_row = self._xml_row_cells(tr, prev_row)
+                            rows.append(row)
+                        t_head, t_tables = self._rows_to_text(rows, table_head)
+                        for t_table in t_tables:
+                            raw_chunks.append({"content": t_head + t_table, "type": "table"})
+                        in_table_group = True
+
+                    body.remove(elem)
+
+        # Добавляем последний чанк
+        current_chunk.extend(pending)
+        flush_chunk()
+
+        if not title:
+            title = os.path.basename(file_path)
+        for chunk in raw_chunks:
+            chunk["_title"] = title
+
+        return self._raw_chunks_to_docs(raw_chunks, doc_id)
+
+    @staticmethod
+    def _docx_paragraph_styles(archive: zipfile.ZipFile) -> Tuple[Dict[str, str], Optional[str]]:
+        """
+        Читает word/styles.xml: соответствие styleId -> имя стиля параграфа (как style.name в python-docx)
+        и имя стиля параграфа по умолчанию.
+        """
+        names, default = {}, None
+        try:
+            with archive.open("word/styles.xml") as xml_file:
+                root = ElementTree.parse(xml_file).getroot()
+        except KeyError:
+            return names, default
+
+        for style in root.iter(_W + "style"):
+            if style.get(_W + "type") != "paragraph":
+                continue
+            name_elem = style.find(_W + "name")
+            name = name_elem.get(_W + "val") if name_elem is not None else None
+            # Встроенные стили хранятся в нижнем регистре ("heading 1"), python-docx показывает "Heading 1"
+            if name and re.fullmatch(r'heading \d', name):
+                name = name.capitalize()
+            names[style.get(_W + "styleId")] = name
+            if style.get(_W + "default") in ("1", "true", "on"):
+                default = name
+        return names, default
+
+    @staticmethod
+    def _xml_paragraph_text(p) -> str:
+        """Текст параграфа w:p по тем же правилам, что Paragraph.text в python-docx"""
+        parts = []
+        for child in p:
+            if child.tag == _W + "r":
+                runs = [child]
+            elif child.tag == _W + "hyperlink":
+                runs = [r for r in child if r.tag == _W + "r"]
+            else:
+                continue
+            for run in runs:
+                for elem in run:
+                    tag = elem.tag
+                    if tag == _W + "t":
+                        parts.append(elem.text or "")
+                    elif tag in (_W + "tab", _W + "ptab"):
+                        parts.append("\t")
+                    elif tag == _W + "br":
+                        parts.append("\n" if elem.get(_W + "type", "textWrapping") == "textWrapping" else "")
+                    elif tag == _W + "cr":
+                        parts.append("\n")
+                    elif tag == _W + "noBreakHyphen":
+                        parts.append("-")
+        return "".join(parts)
+
+    def _xml_row_cells(self, tr, prev_row: Dict[int, str]) -> Tuple[List[str], Dict[int, str]]:
+        """
+        Ячейки строки таблицы w:tr как row.cells в python-docx: объединённая по горизонтали ячейка
+        повторяется gridSpan раз, продолжение вертикального объединения берёт текст ячейки сверху.
+        :param prev_row: Тексты предыдущей строки по смещению в сетке таблицы
+        :return: (тексты ячеек, тексты этой строки по смещению в сетке)
+        """
+        cells = []
+        row = {}
+        grid_before = tr.find(f"{_W}trPr/{_W}gridBefore")
+        offset = int(grid_before.get(_W + "val", 0)) if grid_before is not None else 0
+
+        for tc in tr.findall(_W + "tc"):
+            span_elem = tc.find(f"{_W}tcPr/{_W}gridSpan")
+            span = int(span_elem.get(_W + "val", 1)) if span_elem is not None else 1
+            v_merge = tc.find(f"{_W}tcPr/{_W}vMerge")
+
+            if v_merge is not None and v_merge.get(_W + "val", "continue") == "continue":
+                text = prev_row.get(offset, "")
+            else:
+                text = "\n".join(self._xml_paragraph_text(p) for p in tc.findall(_W + "p"))
+
+            for n in range(span):
+                row[offset + n] = text
+                cells.append(text)
+            offset += span
+        return cells, row
+
     @staticmethod
     def _is_table_context(elements, index):
         """Проверяет, следует ли за параграфом таблица без пустой строки"""
@@ -365,51 +1355,76 @@ class DBConstructor(RAGProcessor):
                 markdown.append("| " + " | ".join(["---"] * len(cells)) + " |")
         return '\n'.join(markdown)
 
-    @staticmethod
-    def _table_to_text(table, table_head):
+    @classmethod
+    def _table_to_text(cls, table, table_head):
         """Преобразовывает таблицу в текст с разделением полей табуляцией (\t)"""
+        return cls._rows_to_text([[cell.text for cell in row.cells] for row in table.rows], table_head)
+
+    @staticmethod
+    def _rows_to_text(table_rows: List[List[str]], table_head: str):
+        """Текст таблицы из текстов ячеек: первая строка идёт в заголовок, остальные - отдельными строками"""
         rows = []
-        for row in table.rows:
-            cells = [cell.text.strip() for cell in row.cells]
-            rows.append("\t".join(cells))
+        for cells in table_rows:
+            rows.append("\t".join(cell.strip() for cell in cells))
         table_head += "\n" + rows[0] + "\n"
         return table_head, rows[1:] # "\n".join(rows)
 # -------------------------------------------------------
 
     def _parse_pdf(self, file_path: str) -> list:
-        """Парсинг PDF с базовым разделением текста и таблиц"""
+        """
+        Парсинг PDF с базовым разделением текста и таблиц.
+        Текст извлекается PyMuPDF за один проход, таблицы - одним вызовом camelot на диапазон
+        из pdf_pages_per_job страниц; диапазоны распределяются по пулу из pdf_workers процессов.
+        """
         doc_id = hashlib.md5(file_path.encode()).hexdigest()[:8]
         chunks = []
 
         with fitz.open(file_path) as pdf:
-            for page_num, page in enumerate(pdf):
-                # Текст страницы
-                text = page.get_text().strip()
-                if text:
-                    chunks.append(LangDoc(
-                        page_content=text,
-                        metadata={
-                            "doc_id": doc_id,
-                            "doc_type": "pdf",
-                            "chunk_id": f"{doc_id}_p{page_num + 1}_text",
-                            "element_type": "text",
-                            "linked": []
-                        }
-                    ))
-
-                # Таблицы
-                tables = read_pdf(file_path, pages=str(page_num + 1), flavor="stream")
-                for i, table in enumerate(tables):
-                    chunks.append(LangDoc(
-                        page_content=table.df.to_json(),
-                        metadata={
-                            "doc_id": doc_id,
-                            "doc_type": "pdf",
-                            "chunk_id": f"{doc_id}_p{page_num + 1}_table{i + 1}",
-                            "element_type": "table",
-                            "linked": [chunks[-1].metadata["chunk_id"]] if chunks else []
-                        }
-                    ))
+            page_texts = [page.get_text().strip() for page in pdf]
+
+        # Таблицы по диапазонам страниц
+        step = max(1, self.pdf_pages_per_job)
+        page_ranges = [f"{start + 1}-{min(start + step, len(page_texts))}" for start in range(0, len(page_texts), step)]
+        workers = min(self.pdf_workers or os.cpu_count() or 1, len(page_ranges))
+
+        if workers > 1:
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+                range_tables = list(pool.map(_extract_pdf_tables, [file_path] * len(page_ranges), page_ranges))
+        else:
+            range_tables = [_extract_pdf_tables(file_path, pages) for pages in page_ranges]
+
+        tables_by_page = {}
+        for tables in range_tables:
+            for page_number, table_json in tables:
+                tables_by_page.setdefault(page_number, []).append(table_json)
+
+        for page_num, text in enumerate(page_texts):
+            # Текст страницы
+            if text:
+                chunks.append(LangDoc(
+                    page_content=text,
+                    metadata={
+                        "doc_id": doc_id,
+                        "doc_type": "pdf",
+                        "chunk_id": f"{doc_id}_p{page_num + 1}_text",
+                        "element_type": "text",
+                        "linked": []
+                    }
+                ))
+
+            # Таблицы
+            for i, table_json in enumerate(tables_by_page.get(page_num + 1, [])):
+                chunks.append(LangDoc(
+                    page_content=table_json,
+                    metadata={
+                        "doc_id": doc_id,
+                        "doc_type": "pdf",
+                        "chunk_id": f"{doc_id}_p{page_num + 1}_table{i + 1}",
+                        "element_type": "table",
+                        "linked": [chunks[-1].metadata["chunk_id"]] if chunks else []
+                    }
+                ))
 
         return chunks
 
@@ -450,32 +1465,125 @@ class DBConstructor(RAGProcessor):
     @staticmethod
     def validate_chunks(chunks: list) -> list:
         crashed = []
+        chunk_ids = {c.metadata["chunk_id"] for c in chunks}
         for chunk in chunks:
             for linked_id in chunk.metadata["linked"]:
-                if not any(c.metadata["chunk_id"] == linked_id for c in chunks):
+                if linked_id not in chunk_ids:
                     crashed.append(f"Битая связь: {chunk.metadata['chunk_id']} → {linked_id}")
         return crashed
 
 # Подготовка к векторизации сложных документов
 
     @staticmethod
-    def validate_link(chunk: LangDoc, chunks: List[LangDoc]):
+    def validate_link(chunk: LangDoc, chunks: List[LangDoc], chunk_ids: Optional[set] = None):
+        """
+        :param chunk_ids: Множество chunk_id всех чанков. При проверке многих чанков его стоит
+            построить один раз и передавать, чтобы не перебирать chunks на каждом вызове
+        """
+        if chunk_ids is None:
+            chunk_ids = {ch.metadata["chunk_id"] for ch in chunks}
         for linked_id in chunk.metadata["linked"]:
-            if not any(ch.metadata["chunk_id"] == linked_id for ch in chunks):
+            if linked_id not in chunk_ids:
                 return None
             else:
                 return chunk.metadata["linked"]
         return None
 
+    def validate_category(self, category_folder: str, report_path: Optional[str] = None) -> tuple:
+        """
+        Проверка целостности связей чанков всех баз категории за один линейный проход.
+        Находит: битые связи (linked на несуществующий chunk_id), повторяющиеся chunk_id,
+        циклы в графе связей (связи считаются неориентированными, пара взаимных ссылок - одно ребро)
+        и чанки-сироты - оторванные от остальных кусков своей статьи (group_id).
+        Документы читаются прямо из index.pkl / chunks.sqlite, модель эмбеддингов не нужна.
+        :param category_folder: Папка категории (все вложенные папки с index.faiss)
+        :param report_path: Если задан, отчёт сохраняется туда в JSON
+        :return: (True - ошибок нет, отчёт)
+        """
+        folders = self.base_folders(category_folder)
+        location = {}  # chunk_id -> папка базы
+        duplicates = {}
+        links = []  # (chunk_id, linked_id, папка)
+        groups = {}  # group_id -> [chunk_id]
+
+        for folder in folders:
+            relative = os.path.relpath(folder, category_folder)
+            for _, doc in self.iter_folder_docstore(folder):
+                chunk_id = doc.metadata.get("chunk_id")
+                if chunk_id is None:
+                    continue
+                if chunk_id in location:
+                    duplicates.setdefault(chunk_id, [location[chunk_id]]).append(relative)
+                    continue
+                location[chunk_id] = relative
+                links.extend((chunk_id, linked_id, relative) for linked_id in doc.metadata.get("linked", []))
+                if doc.metadata.get("group_id") is not None:
+                    groups.setdefault(doc.metadata["group_id"], []).append(chunk_id)
+
+        # Система непересекающихся множеств по неориентированным рёбрам
+        parent = {chunk_id: chunk_id for chunk_id in location}
+
+        def find(x: str) -> str:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        broken, cycles, edges = [], [], set()
+        for chunk_id, linked_id, relative in links:
+            if linked_id not in location:
+                broken.append({"chunk_id": chunk_id, "linked_id": linked_id, "folder": relative})
+                continue
+            edge = (chunk_id, linked_id) if chunk_id <= linked_id else (linked_id, chunk_id)
+            if edge in edges:
+                continue
+            edges.add(edge)
+            root_a, root_b = find(chunk_id), find(linked_id)
+            if root_a == root_b:
+                cycles.append({"edge": list(edge), "folder": relative})
+            else:
+                parent[root_a] = root_b
+
+        orphans = []
+        for group_id, chunk_ids in groups.items():
+            if len(chunk_ids) < 2:
+                continue
+            components = {}
+            for chunk_id in chunk_ids:
+                components.setdefault(find(chunk_id), []).append(chunk_id)
+            main = max(components.values(), key=len)
+            orphans.extend({"chunk_id": chunk_id, "group_id": group_id, "folder": location[chunk_id]}
+                           for members in components.values() if members is not main for chunk_id in members)
+
+        report = {
+            "category": os.path.basename(os.path.normpath(category_folder)),
+            "folders": len(folders),
+            "chunks": len(location),
+            "broken_links": broken,
+            "duplicates": [{"chunk_id": chunk_id, "folders": where} for chunk_id, where in duplicates.items()],
+            "cycles": cycles,
+            "orphans": orphans,
+        }
+        report["ok"] = not (broken or duplicates or cycles or orphans)
+
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return report["ok"], report
+
     def prepare_chunks(self, dry_chunks: list, file_path: str, **params) -> List[LangDoc]:
         processed = []
         doc_id = hashlib.md5(file_path.encode()).hexdigest()[:8]
         last_text_chunk = None  # Хранение последней текстовой порции
 
-        for chunk in dry_chunks:
+        # Разделение всех чанков одним вызовом
+        split_chunks = self.split_texts_recursive([chunk.page_content for chunk in dry_chunks], self.chunk_size, **params)
+
+        for group_num, (chunk, sub_chunks) in enumerate(zip(dry_chunks, split_chunks)):
             # Разделение чанков с учётом типа элемента
-            sub_chunks = self.split_text_recursive(chunk.page_content, self.chunk_size, **params)
             is_table_group = chunk.metadata["element_type"] == "table"
+            # Куски одного исходного чанка - одна статья (см. find_article)
+            group_id = f"{doc_id}_g{group_num}"
 
             for i, sub in enumerate(sub_chunks):
                 # Определение типа и префикса чанка
@@ -498,9 +1606,11 @@ class DBConstructor(RAGProcessor):
                     metadata={
                         "doc_id": doc_id,
                         "chunk_id": chunk_id,
+                        "group_id": group_id,
                         "element_type": chunk_type,
                         "linked": list(set(linked)),  # Удаляем повторяющиеся ссылки
-                        "_title": chunk.metadata["_title"]
+                        # Парсеры PDF и Excel названия не задают - берётся имя файла
+                        "_title": chunk.metadata.get("_title", os.path.splitext(os.path.basename(file_path))[0])
                     }
                 )
                 processed.append(new_chunk)
@@ -540,10 +1650,40 @@ class DBConstructor(RAGProcessor):
 
     def num_tokens_from_string(self, string: str, encoding_name: str) -> int:
         """Возвращает количество токенов в строке"""
-        encoding = tiktoken.get_encoding(encoding_name)
+        encoding = get_tiktoken_encoding(encoding_name)
         self.num_tokens = len(encoding.encode(string))
         return self.num_tokens
 
+    def count_tokens_batch(self, strings: List[str], encoding_name: Optional[str] = None) -> List[int]:
+        """
+        Количество токенов для списка строк (например, чанков) за один вызов tiktoken.
+        :param encoding_name: Кодировка tiktoken. По умолчанию - self.token_encoding
+        :return: Список количеств токенов в порядке строк
+        """
+        encoding = get_tiktoken_encoding(encoding_name or self.token_encoding or "cl100k_base")
+        counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(strings)]
+        self.num_tokens = sum(counts)
+        return counts
+
+    def token_counter(self) -> str:
+        """
+        Чем считается длина в режиме токенов: "tiktoken:<кодировка>" - явно заданная self.token_encoding
+        или модель OpenAI (cl100k_base), иначе "hf:<модель>" - токенизатор самой модели эмбеддингов HuggingFace.
+        Токенизатор модели нужен, чтобы чанк не обрезался по её лимиту (512 токенов у E5): кириллицу она
+        делит на заметно большее число токенов, чем tiktoken. Префикс "passage: " и служебные токены
+        в длину не входят - chunk_size задаётся с запасом под них.
+        """
+        if self.token_encoding:
+            return f"tiktoken:{self.token_encoding}"
+        if self.embedding_model_type == "openai" or not self.embedding_model_name:
+            return "tiktoken:cl100k_base"
+        return f"hf:{self.embedding_model_name}"
+
+    def token_length_function(self) -> Callable[[str], int]:
+        """Функция длины в токенах для сплиттера (см. token_counter)"""
+        kind, name = self.token_counter().split(":", 1)
+        return token_length_function(name) if kind == "tiktoken" else hf_token_length_function(name)
+
     def split_text_recursive(
             self,
             text: str,
@@ -558,6 +1698,19 @@ class DBConstructor(RAGProcessor):
             is_separator_regex: bool = False
             chunk_overlap: int = 0
             Другие параметры RecursiveCharacterTextSplitter
+        При self.chunk_unit == "tokens" длина считается в токенах модели эмбеддингов (см. token_counter).
+        """
+        self.source_chunks = self.split_texts_recursive([text], chunk_size, **params)[0]
+        return self.source_chunks
+
+    _ENGINE_PARAMS = {'separators', 'is_separator_regex', 'chunk_overlap', 'keep_separator', 'strip_whitespace',
+                      'length_function'}
+
+    def split_texts_recursive(self, texts: List[str], chunk_size: int, **params) -> List[List[str]]:
+        """
+        Делит список текстов на чанки за один вызов. Параметры те же, что у split_text_recursive.
+        Сплиттер берётся из кэша get_splitter_engine и не создаётся заново для каждого текста.
+        :return: Список списков чанков, по одному на каждый текст
         """
         # Устанавливаем значения по умолчанию
         default_params = {
@@ -566,17 +1719,21 @@ class DBConstructor(RAGProcessor):
             'chunk_overlap': 0
         }
 
+        # В режиме токенов chunk_size и chunk_overlap считаются в токенах модели эмбеддингов
+        if self.chunk_unit == "tokens":
+            default_params['length_function'] = self.token_length_function()
+
         # Объединяем переданные параметры с дефолтными (переданные имеют приоритет)
         final_params = {**default_params, **params}
 
-        # Создаем сплиттер с объединенными параметрами
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            **final_params  # Распаковываем все параметры
-        )
+        if set(final_params) - self._ENGINE_PARAMS:
+            # Параметры, которых нет в SplitterEngine, обрабатывает сам RecursiveCharacterTextSplitter
+            splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, **final_params)
+            return [splitter.split_text(text) for text in texts]
 
-        self.source_chunks = splitter.split_text(text)
-        return self.source_chunks
+        final_params['separators'] = tuple(final_params['separators'])
+        engine = get_splitter_engine(chunk_size, **final_params)
+        return engine.split_many(texts)
 
     def simple_split_text_recursive(self, text: str, chunk_size: int, overlap=0):
         """
@@ -642,7 +1799,7 @@ class DBConstructor(RAGProcessor):
         try:
             encoding = tiktoken.encoding_for_model(model)
         except KeyError:
-            encoding = tiktoken.get_encoding('cl100k_base')
+            encoding = get_tiktoken_encoding('cl100k_base')
 
         if model in ['gpt-4o-mini', 'gpt-4o', 'gpt-4o-latest']:
             num_tokens = 0
@@ -757,6 +1914,7 @@ class DBConstructor(RAGProcessor):
                 )
                 self.distance_strategy = "COSINE" if encode_kwargs.get('normalize_embeddings', False) else "L2"
 
+            self.embeddings = self._with_cache(self.embeddings, model_name, self.distance_strategy == "COSINE")
             self.embedding_model_name = model_name
             self.embedding_model_type = model_type
             return True
@@ -765,8 +1923,39 @@ class DBConstructor(RAGProcessor):
             print(f"Ошибка загрузки модели: {str(e)}")
             return False
 
+    def enable_embedding_cache(self, cache_dir: str, max_entries: int = 100_000):
+        """
+        Включает персистентный кэш эмбеддингов. Действует на уже загруженную модель и на все модели,
+        загружаемые позже (load_embedding_model, vectorizator, merge_databases, set_embeddings).
+        :param cache_dir: Папка кэша
+        :param max_entries: Максимальное число векторов на одну модель
+        """
+        self.embedding_cache_dir = cache_dir
+        self.embedding_cache_size = max_entries
+        if self.embeddings is not None and self.embedding_model_name:
+            self.embeddings = self._with_cache(self.embeddings, self.embedding_model_name,
+                                               self.distance_strategy == "COSINE")
+
+    def _with_cache(self, embeddings: Embeddings, model_name: str, normalized: bool) -> Embeddings:
+        """Оборачивает модель в CachedEmbeddings, если кэш включён"""
+        if not self.embedding_cache_dir or embeddings is None:
+            return embeddings
+        if isinstance(embeddings, CachedEmbeddings):
+            embeddings = embeddings.base
+        cache = EmbeddingCache.open(self.embedding_cache_dir, model_name, normalized, self.embedding_cache_size)
+        return CachedEmbeddings(embeddings, cache)
+
     def vectorizator(self, docs: list, db_folder: str, **kwargs):
-        """Универсальный метод векторизации с автонастройкой для E5 и поддержкой предзагруженной модели"""
+        """
+        Универсальный метод векторизации с автонастройкой для E5 и поддержкой предзагруженной модели.
+        Потоковый режим включается параметром batch_size: чанки векторизуются пакетами и добавляются
+        в индекс по мере готовности, не чаще чем через checkpoint_every пакетов (по умолчанию 10) частичная база
+        сохраняется в db_folder. При resume=True (по умолчанию) прерванная сборка продолжается
+        с последней контрольной точки.
+        Тип индекса задаётся параметром index_spec (по умолчанию self.index_spec), см. _resolve_index_spec.
+        Формат хранилища чанков - параметром docstore_format (по умолчанию self.docstore_format).
+        Разделы по типу чанка (text_db / table_db) пишутся только при partitions=True.
+        """
         try:
             # Всегда инициализируем encode_kwargs по умолчанию
             encode_kwargs = kwargs.get("encode_kwargs", {})
@@ -815,6 +2004,8 @@ class DBConstructor(RAGProcessor):
                 else:
                     return False, f"Неподдерживаемый тип модели: {model_type}"
 
+                embeddings = self._with_cache(embeddings, model_name, distance_strategy == "COSINE")
+
             # Для E5 моделей добавляем префиксы
             if is_e5_model:
                 docs = self._add_e5_prefixes(docs)
@@ -824,12 +2015,34 @@ class DBConstructor(RAGProcessor):
                 return False, "Нет данных для векторизации"
 
             # Создаем и сохраняем индекс
-            self.db = FAISS.from_documents(
-                documents=docs,
-                embedding=embeddings,
-                distance_strategy=distance_strategy
-            )
-            self.db.save_local(db_folder)
+            index_spec = kwargs.get("index_spec", self.index_spec)
+            docstore_format = kwargs.get("docstore_format", self.docstore_format)
+            if kwargs.get("batch_size"):
+                self.db, index_spec = self._stream_vectorize(
+                    docs, db_folder, embeddings, distance_strategy,
+                    batch_size=kwargs["batch_size"],
+                    checkpoint_every=kwargs.get("checkpoint_every", 10),
+                    resume=kwargs.get("resume", True),
+                    index_spec=index_spec,
+                    docstore_format=docstore_format,
+                    model_name=model_name
+                )
+            elif self._is_flat_spec(index_spec):
+                self.db = FAISS.from_documents(
+                    documents=docs,
+                    embedding=embeddings,
+                    distance_strategy=distance_strategy
+                )
+                self._save_db(db_folder, self.db, docstore_format)
+                index_spec = {"type": "flat"}
+            else:
+                texts = [doc.page_content for doc in docs]
+                vectors = embeddings.embed_documents(texts)
+                self.db, index_spec = self._faiss_db_from_vectors(
+                    texts, vectors, [doc.metadata for doc in docs], embeddings, distance_strategy, index_spec
+                )
+                self._save_db(db_folder, self.db, docstore_format)
+                self._save_full_vectors(db_folder, vectors, index_spec)
 
             # Сохраняем метаданные с дополнительными параметрами
             metadata = {
@@ -839,11 +2052,15 @@ class DBConstructor(RAGProcessor):
                 "normalized": encode_kwargs.get('normalize_embeddings', False) if not hasattr(self, 'embeddings') else (
                             self.distance_strategy == "COSINE"),
                 "distance_strategy": distance_strategy,
-                "is_e5_model": is_e5_model
+                "is_e5_model": is_e5_model,
+                "index": index_spec,
+                "docstore": docstore_format,
+                "mmap": self.mmap_load
             }
+            metadata["partitions"], metadata["partitions_complete"] = self._write_partitions(
+                db_folder, metadata, kwargs.get("partitions", False))
             try:
-                with open(os.path.join(db_folder, "metadata.json"), "w", encoding="utf-8") as f:
-                    json.dump(metadata, f, indent=2, ensure_ascii=False)
+                self._write_metadata(db_folder, metadata)
                 return True, f"База успешно создана в {db_folder}"
             except Exception as e:
                 return False, f"Ошибка записи метаданных: {str(e)}"
@@ -851,6 +2068,348 @@ class DBConstructor(RAGProcessor):
         except Exception as e:
             return False, f"Ошибка векторизации: {str(e)}"
 
+    CHECKPOINT_GROWTH = 0.5  # Во сколько раз (сверх 1) должна вырасти база между контрольными точками
+
+    def _stream_vectorize(self,
+                          docs: List[LangDoc],
+                          db_folder: str,
+                          embeddings: Embeddings,
+                          distance_strategy: str,
+                          batch_size: int,
+                          checkpoint_every: int,
+                          resume: bool,
+                          index_spec: Optional[dict] = None,
+                          docstore_format: str = "pickle",
+                          model_name: str = "") -> Tuple[FAISS, dict]:
+        """
+        Потоковая сборка индекса: пакеты по batch_size чанков, контрольная точка не чаще чем через checkpoint_every
+        пакетов и не раньше, чем база вырастет в 1 + CHECKPOINT_GROWTH раза с прошлой точки: каждая точка
+        переписывает частичную базу целиком, и при геометрическом шаге суммарная запись остаётся линейной
+        по объёму корпуса (не больше (1 + 1 / CHECKPOINT_GROWTH) размеров итоговой базы), а при сбое теряется
+        около трети сделанной работы.
+        Контрольная точка - частичная база в db_folder и checkpoint.json с числом обработанных чанков
+        и отпечатком сборки (всегда в формате index.pkl). Отпечаток учитывает тексты и метаданные чанков,
+        модель, метрику и запрошенный тип индекса: при изменении любого из них сборка начинается заново.
+        После успешной сборки checkpoint.json удаляется, а база записывается в формате docstore_format.
+        Обучаемые индексы (IVF, IVF-PQ, int8) создаются, когда накоплено достаточно векторов для обучения.
+        При rescore векторы полной точности пишутся в vectors.npy по мере векторизации.
+        Ограничение: batch_size ограничивает размер вызова модели и потерю работы при сбое, но не пиковую память -
+        список docs, растущий индекс и хранилище чанков остаются в памяти целиком.
+        :return: (база, итоговая спецификация индекса)
+        """
+        checkpoint_path = os.path.join(db_folder, "checkpoint.json")
+        full_path = os.path.join(db_folder, "vectors.npy")
+        fingerprint = hashlib.sha1(json.dumps(
+            {"model": model_name, "distance": str(distance_strategy), "index": index_spec}, sort_keys=True, default=str
+        ).encode("utf-8"))
+        for doc in docs:
+            fingerprint.update(doc.page_content.encode("utf-8"))
+            fingerprint.update(b"\0")
+            fingerprint.update(json.dumps(doc.metadata, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+            fingerprint.update(b"\0")
+        fingerprint = fingerprint.hexdigest()
+
+        db, done, resolved = None, 0, None
+        if resume and os.path.exists(checkpoint_path):
+            try:
+                with open(checkpoint_path, "r", encoding="utf-8") as f:
+                    checkpoint = json.load(f)
+                if checkpoint.get("fingerprint") == fingerprint:
+                    db = FAISS.load_local(db_folder, embeddings=embeddings, allow_dangerous_deserialization=True)
+                    done = checkpoint["done"]
+                    resolved = checkpoint.get("index", {"type": "flat"})
+                    self._apply_index_params(db.index, resolved)
+                    # Сбой между записью индекса и контрольной точки - начинаем заново
+                    if db.index.ntotal != done or (resolved.get("rescore") and not os.path.exists(full_path)):
+                        db, done, resolved = None, 0, None
+            except Exception as e:
+                print(f"Контрольная точка {checkpoint_path} не загружена: {str(e)}")
+                db, done, resolved = None, 0, None
+
+        os.makedirs(db_folder, exist_ok=True)
+        checkpoint_done, since_checkpoint = done, 0  # Чанков в последней контрольной точке, пакетов после неё
+        pending = ([], [], [])  # Тексты, векторы и метаданные до создания индекса
+        full_vectors = None  # vectors.npy, открытый через memmap
+        for start in range(done, len(docs), batch_size):
+            batch = docs[start:start + batch_size]
+            texts = [doc.page_content for doc in batch]
+            vectors = embeddings.embed_documents(texts)
+            metadatas = [doc.metadata for doc in batch]
+            done = start + len(batch)
+            since_checkpoint += 1
+
+            if resolved is None:
+                resolved = self._resolve_index_spec(index_spec, len(docs), len(vectors[0]))
+            if resolved.get("rescore"):
+                if full_vectors is None:
+                    full_vectors = np.lib.format.open_memmap(
+                        full_path, mode="r+" if start else "w+", dtype=np.float32, shape=(len(docs), len(vectors[0]))
+                    )
+                full_vectors[start:done] = vectors
+
+            if db is None:
+                pending[0].extend(texts)
+                pending[1].extend(vectors)
+                pending[2].extend(metadatas)
+                if len(pending[0]) < self._train_size(resolved) and done < len(docs):
+                    continue
+                db, resolved = self._faiss_db_from_vectors(*pending, embeddings, distance_strategy, resolved)
+                pending = ([], [], [])
+            else:
+                db.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+
+            if (since_checkpoint >= checkpoint_every and done < len(docs)
+                    and done - checkpoint_done >= self.CHECKPOINT_GROWTH * checkpoint_done):
+                checkpoint_done, since_checkpoint = done, 0
+                db.save_local(db_folder)
+                if full_vectors is not None:
+                    full_vectors.flush()
+                tmp_path = checkpoint_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"fingerprint": fingerprint, "done": done, "index": resolved}, f)
+                os.replace(tmp_path, checkpoint_path)
+
+        self._save_db(db_folder, db, docstore_format)
+        if full_vectors is not None:
+            full_vectors.flush()
+            del full_vectors
+        elif not resolved.get("rescore"):
+            self._save_full_vectors(db_folder, None, resolved)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return db, resolved
+
+    #=======================================================================
+    # Типы индексов FAISS
+
+    INDEX_DEFAULTS = {
+        "flat": {},
+        "ivf": {"nlist": None, "nprobe": 8},
+        "hnsw": {"M": 32, "efConstruction": 200, "efSearch": 64},
+        "ivfpq": {"nlist": None, "nprobe": 8, "m": 64, "nbits": 8},
+    }
+
+    # Скалярное квантование векторов: строка index_factory
+    QUANTIZATIONS = {"fp16": "SQfp16", "int8": "SQ8"}
+
+    @staticmethod
+    def _is_flat_spec(index_spec: Optional[dict]) -> bool:
+        """Обычный плоский индекс float32, который строит сам langchain"""
+        return not index_spec or (str(index_spec.get("type", "flat")).lower() == "flat"
+                                  and not index_spec.get("quantization"))
+
+    @classmethod
+    def _resolve_index_spec(cls, index_spec: Optional[dict], n_vectors: int, dimension: int) -> dict:
+        """
+        Дополняет спецификацию индекса значениями по умолчанию и подгоняет её под объём данных.
+        Варианты: {"type": "flat"}, {"type": "ivf", "nlist", "nprobe"}, {"type": "hnsw", "M", "efConstruction",
+        "efSearch"}, {"type": "ivfpq", "nlist", "nprobe", "m", "nbits"}. Не заданный nlist = 4 * sqrt(N).
+        Для flat, ivf и hnsw можно задать "quantization": "fp16" или "int8" - векторы в индексе хранятся
+        в половинной точности (в 2 раза меньше памяти) или квантуются в байт (в 4 раза меньше).
+        "rescore": True дополнительно сохраняет векторы полной точности в vectors.npy: при поиске они читаются
+        через memmap, и лучшие кандидаты пересчитываются точно (см. _rescored_search_with_scores).
+        :param n_vectors: Количество векторов, на которых будет обучаться индекс
+        :param dimension: Размерность векторов
+        """
+        index_spec = dict(index_spec or {})
+        index_type = str(index_spec.pop("type", "flat")).lower()
+        if index_type not in cls.INDEX_DEFAULTS:
+            raise ValueError(f"Неподдерживаемый тип индекса: {index_type}. "
+                             f"Доступные варианты: {', '.join(cls.INDEX_DEFAULTS)}")
+
+        resolved = {"type": index_type, **cls.INDEX_DEFAULTS[index_type],
+                    "quantization": None, "rescore": False, **index_spec}
+        if resolved["quantization"] not in (None, *cls.QUANTIZATIONS):
+            raise ValueError(f"Неподдерживаемое квантование: {resolved['quantization']}. "
+                             f"Доступные варианты: {', '.join(cls.QUANTIZATIONS)}")
+        if index_type == "ivfpq" and resolved["quantization"]:
+            raise ValueError("Индекс ivfpq уже сжимает векторы, квантование к нему не применяется")
+        if index_type in ("ivf", "ivfpq"):
+            nlist = resolved["nlist"] or int(4 * math.sqrt(n_vectors))
+            # k-means FAISS нужно не меньше 39 векторов на кластер
+            resolved["nlist"] = max(1, min(nlist, n_vectors // 39))
+            resolved["nprobe"] = max(1, min(resolved["nprobe"], resolved["nlist"]))
+        if index_type == "ivfpq":
+            m = max(1, min(resolved["m"], dimension))
+            while dimension % m:
+                m -= 1
+            resolved["m"] = m
+            # Для обучения кодовых книг PQ нужно не меньше 39 * 2^nbits векторов
+            resolved["nbits"] = max(1, min(resolved["nbits"], int(math.log2(max(n_vectors // 39, 2)))))
+        return resolved
+
+    @staticmethod
+    def _train_size(resolved_spec: dict) -> int:
+        """Сколько векторов накопить перед созданием индекса этого типа"""
+        size = 0
+        if resolved_spec["type"] == "ivf":
+            size = 39 * resolved_spec["nlist"]
+        elif resolved_spec["type"] == "ivfpq":
+            size = 39 * max(resolved_spec["nlist"], 2 ** resolved_spec["nbits"])
+        if resolved_spec.get("quantization") == "int8":
+            # Диапазоны квантования по измерениям оцениваются на выборке
+            size = max(size, 10_000)
+        return size
+
+    @classmethod
+    def _build_faiss_index(cls, resolved_spec: dict, dimension: int, distance_strategy: str,
+                           train_vectors: np.ndarray):
+        """Создаёт пустой индекс FAISS по спецификации и обучает его на train_vectors, если нужно"""
+        # Как в langchain: скалярное произведение только для MAX_INNER_PRODUCT, иначе L2
+        metric = faiss.METRIC_INNER_PRODUCT if distance_strategy == "MAX_INNER_PRODUCT" else faiss.METRIC_L2
+        index_type = resolved_spec["type"]
+        storage = cls.QUANTIZATIONS.get(resolved_spec.get("quantization"))
+        if index_type == "ivf":
+            description = f"IVF{resolved_spec['nlist']},{storage or 'Flat'}"
+        elif index_type == "hnsw":
+            description = f"HNSW{resolved_spec['M']}" + (f",{storage}" if storage else "")
+        elif index_type == "ivfpq":
+            description = f"IVF{resolved_spec['nlist']},PQ{resolved_spec['m']}x{resolved_spec['nbits']}"
+        else:
+            description = storage or "Flat"
+
+        index = faiss.index_factory(dimension, description, metric)
+        if index_type == "hnsw":
+            faiss.downcast_index(index).hnsw.efConstruction = resolved_spec["efConstruction"]
+        if not index.is_trained:
+            index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+        cls._apply_index_params(index, resolved_spec)
+        return index
+
+    @staticmethod
+    def _apply_index_params(index, index_spec: Optional[dict]):
+        """Применяет к индексу параметры поиска из спецификации (nprobe, efSearch)"""
+        if not index_spec:
+            return
+        index_type = index_spec.get("type", "flat")
+        if index_type in ("ivf", "ivfpq"):
+            ivf = faiss.extract_index_ivf(index)
+            ivf.nprobe = index_spec.get("nprobe", 8)
+            ivf.make_direct_map()  # MMR-поиск langchain восстанавливает векторы по номеру (reconstruct)
+        elif index_type == "hnsw":
+            faiss.downcast_index(index).hnsw.efSearch = index_spec.get("efSearch", 64)
+
+    @staticmethod
+    def _save_full_vectors(db_folder: str, vectors: Optional[list], index_spec: dict):
+        """Сохраняет векторы полной точности для rescore (vectors.npy) или удаляет устаревший файл"""
+        full_path = os.path.join(db_folder, "vectors.npy")
+        if index_spec.get("rescore") and vectors is not None:
+            np.save(full_path, np.asarray(vectors, dtype=np.float32))
+        elif os.path.exists(full_path):
+            os.remove(full_path)
+
+    @staticmethod
+    def _index_vectors(index) -> np.ndarray:
+        """Все векторы индекса в порядке номеров (для IVF включается прямая адресация)"""
+        try:
+            faiss.extract_index_ivf(index).make_direct_map()
+        except RuntimeError:
+            pass
+        return index.reconstruct_n(0, index.ntotal)
+
+    def _faiss_db_from_vectors(self,
+                               texts: List[str],
+                               vectors: list,
+                               metadatas: List[dict],
+                               embeddings: Embeddings,
+                               distance_strategy: str,
+                               index_spec: Optional[dict] = None) -> Tuple[FAISS, dict]:
+        """
+        Создаёт FAISS-базу из готовых векторов с индексом по спецификации.
+        :return: (база, итоговая спецификация индекса)
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        resolved = self._resolve_index_spec(index_spec, len(vectors), vectors.shape[1])
+        index = self._build_faiss_index(resolved, vectors.shape[1], distance_strategy, vectors)
+        db = FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+            distance_strategy=distance_strategy
+        )
+        db.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+        return db, resolved
+
+    # Разделы базы по типу чанка (element_type -> вложенная папка): фильтрованный поиск по типу
+    # становится точным поиском без фильтра по меньшему индексу
+    PARTITIONS = {"text": "text_db", "table": "table_db"}
+
+    def _write_partitions(self, db_folder: str, metadata: dict, enabled: bool = True) -> Tuple[Optional[dict], bool]:
+        """
+        Записывает разделы сохранённой базы по element_type в папки PARTITIONS.
+        Векторы берутся из самой базы (vectors.npy или индекс), модель эмбеддингов не нужна. Тип индекса
+        раздела - как у основной базы, nlist пересчитывается под объём раздела. Если все чанки базы одного
+        типа, раздел не копируется: в metadata.json он отмечается как "." (сама основная база).
+        Устаревшие папки разделов удаляются.
+        :param metadata: Метаданные основной базы (основа для metadata.json разделов)
+        :param enabled: False - разделы не пишутся, старые удаляются
+        :return: ({element_type: папка раздела или "."} или None, если разделов нет; покрывают ли разделы
+            все чанки базы) - для metadata.json ("partitions", "partitions_complete")
+        """
+        members = {element_type: [] for element_type in self.PARTITIONS}
+        total = 0
+        if enabled:
+            for i, doc in self.iter_folder_docstore(db_folder):
+                total += 1
+                if doc.metadata.get("element_type") in members:
+                    members[doc.metadata["element_type"]].append((i, doc))
+
+        partitions, vectors, index = {}, None, None
+        for element_type, folder_name in self.PARTITIONS.items():
+            folder = os.path.join(db_folder, folder_name)
+            chunks = members[element_type]
+            if not chunks or len(chunks) == total:
+                shutil.rmtree(folder, ignore_errors=True)
+                if chunks:
+                    partitions[element_type] = "."
+                continue
+
+            if vectors is None:
+                index = faiss.read_index(os.path.join(db_folder, "index.faiss"))
+                full_path = os.path.join(db_folder, "vectors.npy")
+                vectors = np.load(full_path, mmap_mode="r") if os.path.exists(full_path) else self._index_vectors(index)
+            part_vectors = np.ascontiguousarray(vectors[[i for i, _ in chunks]], dtype=np.float32)
+
+            index_spec = {k: v for k, v in (metadata.get("index") or {}).items() if k != "nlist"}
+            if self._is_flat_spec(index_spec):
+                index_spec = {"type": "flat"}
+                flat_type = faiss.IndexFlatIP if index.metric_type == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2
+                part_index = flat_type(index.d)
+            else:
+                index_spec = self._resolve_index_spec(index_spec, len(part_vectors), part_vectors.shape[1])
+                part_index = self._build_faiss_index(index_spec, part_vectors.shape[1],
+                                                     metadata["distance_strategy"], part_vectors)
+            part_index.add(part_vectors)
+
+            self._write_faiss_folder(folder, part_index, {doc.id: doc for _, doc in chunks},
+                                     {n: doc.id for n, (_, doc) in enumerate(chunks)},
+                                     metadata.get("docstore", "pickle"))
+            self._save_full_vectors(folder, part_vectors, index_spec)
+            self._write_metadata(folder, {**{k: v for k, v in metadata.items()
+                                             if k not in ("partitions", "partitions_complete")},
+                                          "index": index_spec, "partition": element_type})
+            partitions[element_type] = folder_name
+
+        covered = sum(len(members[element_type]) for element_type in partitions)
+        return partitions or None, bool(partitions) and covered == total
+
+    @classmethod
+    def base_folders(cls, root: str) -> List[str]:
+        """Папки с index.faiss внутри root, без папок разделов (PARTITIONS)"""
+        folders = []
+        for folder, dirs, files in os.walk(root):
+            dirs[:] = sorted(d for d in dirs if d not in cls.PARTITIONS.values())
+            if "index.faiss" in files:
+                folders.append(folder)
+        return sorted(folders)
+
+    @staticmethod
+    def _write_metadata(db_folder: str, metadata: dict):
+        """Записывает metadata.json в папку базы"""
+        with open(os.path.join(db_folder, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2, ensure_ascii=False)
+
     @staticmethod
     def _add_e5_prefixes(docs):
         """Добавляет E5-префиксы к документам"""
@@ -863,6 +2422,8 @@ class DBConstructor(RAGProcessor):
     @staticmethod
     def _get_embedding_dimension(embeddings):
         """Определение размерности с обработкой исключений"""
+        if isinstance(embeddings, CachedEmbeddings):
+            embeddings = embeddings.base
         try:
             if isinstance(embeddings, OpenAIEmbeddings):
                 return len(embeddings.embed_query("test"))
@@ -872,38 +2433,404 @@ class DBConstructor(RAGProcessor):
             print(f"Ошибка определения размерности: {str(e)}")
         return "unknown"
 
+    #=======================================================================
+    # Сборка баз из каталога документов
+
+    SUPPORTED_EXTENSIONS = ('.docx', '.pdf', '.xlsx', '.xls')
+
+    def build_databases(self,
+                        root_folder: str,
+                        out_root: str,
+                        chunks_root: Optional[str] = None,
+                        workers: Optional[int] = None,
+                        batch_size: int = 256,
+                        incremental: bool = False,
+                        merged_root: Optional[str] = None,
+                        validate: bool = False,
+                        verbose: bool = False,
+                        **params) -> tuple:
+        """
+        Параллельная сборка FAISS-баз для всех документов из root_folder.
+        Структура входа: root_folder/<категория>/<документ>, выхода: out_root/<категория>/<имя документа>.
+        Парсинг и разбиение на чанки выполняются в пуле процессов, эмбеддинги считаются
+        в одном потоке крупными пакетами, общими для нескольких документов.
+        :param root_folder: Папка с категориями документов
+        :param out_root: Корневая папка для FAISS-баз
+        :param chunks_root: Если задана, сюда пишутся текстовые дампы чанков (как в docxparser.py)
+        :param workers: Количество процессов парсинга. По умолчанию - число ядер
+        :param batch_size: Размер пакета для модели эмбеддингов
+        :param incremental: Пересобирать только добавленные, изменённые и удалённые документы
+            по манифесту out_root/<категория>/manifest.json
+        :param merged_root: Если задана, базы каждой изменённой категории объединяются в сводную базу
+            merged_root/<категория> - одну на категорию, документы в ней различаются по doc_id и _title
+        :param validate: Проверить связи чанков каждой изменённой категории (validate_category), отчёт -
+            в out_root/<категория>/validation.json, категория с ошибками попадает в errors
+        :param verbose: Печать прогресса и итоговой статистики
+        :param params: Параметры разбиения для prepare_chunks (separators, is_separator_regex, chunk_overlap)
+        :return: (True, статистика по стадиям) или (False, сообщение об ошибке)
+        """
+        if self.embeddings is None:
+            return False, str(EmbeddingsNotInitialized())
+        if not os.path.isdir(root_folder):
+            return False, f"Папка {root_folder} не существует"
+
+        build_params = self._manifest_params(**params)
+        jobs = []
+        manifests = {}  # категория -> новый манифест
+        changed = set()  # категории, объединённую базу которых нужно пересобрать
+        skipped, deleted = 0, 0
+
+        # Категории источника и категории прошлых сборок (с манифестом), удалённые из источника целиком
+        categories = {c for c in os.listdir(root_folder) if os.path.isdir(os.path.join(root_folder, c))}
+        if os.path.isdir(out_root):
+            categories |= {c for c in os.listdir(out_root) if os.path.exists(os.path.join(out_root, c, "manifest.json"))}
+
+        for category in sorted(categories):
+            category_folder = os.path.join(root_folder, category)
+
+            # Базы прошлой сборки удаляются по старому манифесту всегда,
+            # а переиспользуются - только при тех же параметрах сборки и в режиме incremental
+            old_manifest = self._load_manifest(os.path.join(out_root, category))
+            previous_docs = old_manifest.get("documents", {})
+            old_docs = previous_docs if incremental and old_manifest.get("params") == build_params else {}
+
+            manifest = {"params": build_params, "documents": {}}
+            doc_names = sorted(os.listdir(category_folder)) if os.path.isdir(category_folder) else []
+            for doc_name in doc_names:
+                if not doc_name.endswith(self.SUPPORTED_EXTENSIONS):
+                    continue
+                cut_name = os.path.splitext(doc_name)[0]
+                doc_file = os.path.join(category_folder, doc_name)
+                db_folder = os.path.join(out_root, category, cut_name)
+                entry = {"hash": self._file_hash(doc_file), "db_folder": cut_name}
+                manifest["documents"][doc_name] = entry
+
+                if old_docs.get(doc_name) == entry and os.path.isdir(db_folder):
+                    skipped += 1
+                    continue
+                jobs.append((doc_file, db_folder))
+                changed.add(category)
+
+            # Удалённые документы: убираем их базы
+            for doc_name, entry in previous_docs.items():
+                if doc_name not in manifest["documents"]:
+                    shutil.rmtree(os.path.join(out_root, category, entry["db_folder"]), ignore_errors=True)
+                    changed.add(category)
+                    deleted += 1
+                    if verbose: print(f"Удалена база: {os.path.join(out_root, category, entry['db_folder'])}")
+
+            manifests[category] = manifest
+
+        if not manifests or not (jobs or skipped or deleted):
+            return False, "Нет документов для обработки"
+
+        if jobs:
+            stats = self._run_build_pipeline(jobs, chunks_root, workers, batch_size, verbose, **params)
+        else:
+            stats = {"documents": 0, "chunks": 0, "errors": {}}
+        stats.update({"skipped": skipped, "deleted": deleted})
+
+        for category, manifest in manifests.items():
+            # Документы с ошибками не попадают в манифест, чтобы пересобраться при следующем запуске
+            for doc_name in list(manifest["documents"]):
+                if os.path.join(root_folder, category, doc_name) in stats["errors"]:
+                    del manifest["documents"][doc_name]
+            self._save_manifest(os.path.join(out_root, category), manifest)
+
+        if merged_root:
+            for category in sorted(changed):
+                ok, msg = self._merge_category(os.path.join(out_root, category), os.path.join(merged_root, category),
+                                               manifests[category])
+                if not ok: stats["errors"][category] = msg
+                elif verbose: print(msg)
+
+        if validate:
+            stats["validation"] = {}
+            for category in sorted(changed):
+                category_out = os.path.join(out_root, category)
+                ok, report = self.validate_category(category_out, os.path.join(category_out, "validation.json"))
+                counts = {key: len(report[key]) for key in ("broken_links", "duplicates", "cycles", "orphans")}
+                stats["validation"][category] = counts
+                if not ok: stats["errors"][category] = f"Ошибки связей чанков: {counts}"
+                if verbose: print(f"Проверка {category}: {counts}")
+
+        return True, stats
+
+    def _manifest_params(self, **params) -> dict:
+        """
+        Параметры сборки, при изменении которых категория пересобирается целиком: всё, от чего зависят
+        файлы баз документов и сводной базы (разбиение, модель, тип индекса, хранилище, разделы)
+        """
+        return {
+            "chunk_size": self.chunk_size,
+            "chunk_unit": self.chunk_unit,
+            "token_encoding": self.token_counter() if self.chunk_unit == "tokens" else None,
+            "separators": list(params.get("separators", ['\n\n', '\n', ' ', ''])),
+            "is_separator_regex": params.get("is_separator_regex", False),
+            "chunk_overlap": params.get("chunk_overlap", 0),
+            "embedding_model": self.embedding_model_name,
+            "distance_strategy": self.distance_strategy,
+            "index_spec": json.loads(json.dumps(self.index_spec)),  # Как после записи в manifest.json
+            "docstore_format": self.docstore_format,
+            "docx_backend": self.docx_backend,
+            "mmap_load": self.mmap_load,
+            "partition_bases": self.partition_bases
+        }
+
+    @staticmethod
+    def _file_hash(file_path: str) -> str:
+        """SHA-256 содержимого файла"""
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def _load_manifest(category_folder: str) -> dict:
+        """Загружает манифест категории. Если его нет или он повреждён - пустой словарь"""
+        try:
+            with open(os.path.join(category_folder, "manifest.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def _save_manifest(category_folder: str, manifest: dict):
+        os.makedirs(category_folder, exist_ok=True)
+        with open(os.path.join(category_folder, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+    def _merge_category(self, category_folder: str, output_folder: str, manifest: dict) -> tuple:
+        """Пересобирает объединённую базу категории из баз документов манифеста"""
+        folders = [os.path.join(category_folder, entry["db_folder"]) for entry in manifest["documents"].values()]
+        folders = [f for f in folders if os.path.isdir(f)]
+        if not manifest["documents"]:
+            # Все документы категории удалены - сводная база больше не нужна
+            shutil.rmtree(output_folder, ignore_errors=True)
+            return True, f"Удалена сводная база {output_folder}"
+        if not folders:
+            return False, f"Нет баз для объединения в {category_folder}"
+
+        shutil.rmtree(output_folder, ignore_errors=True)
+        if len(folders) == 1:
+            shutil.copytree(folders[0], output_folder)
+            _, meta = self._load_metadata(output_folder)
+            if meta:
+                meta["partitions"], meta["partitions_complete"] = self._write_partitions(output_folder, meta,
+                                                                                         self.partition_bases)
+                self._write_metadata(output_folder, meta)
+            return True, f"Скопирована единственная база в {output_folder}"
+        return self.merge_databases(folders, output_folder)
+
+    def _run_build_pipeline(self,
+                            jobs: List[Tuple[str, str]],
+                            chunks_root: Optional[str],
+                            workers: Optional[int],
+                            batch_size: int,
+                            verbose: bool,
+                            **params) -> dict:
+        """
+        Конвейер сборки: пул процессов (парсинг + чанки) -> поток эмбеддингов (пакеты) -> запись FAISS.
+        :param jobs: Список пар (путь к документу, папка базы)
+        :return: Статистика по стадиям
+        """
+        workers = workers or os.cpu_count() or 1
+        started = time.perf_counter()
+        stats = {
+            "documents": len(jobs),
+            "chunks": 0,
+            "parse": {"seconds": 0.0, "cpu_seconds": 0.0},
+            "embed": {"seconds": 0.0, "batches": 0},
+            "write": {"seconds": 0.0, "folders": 0},
+            "errors": {}
+        }
+
+        pending = {}  # file_path -> {"db_folder", "docs", "vectors", "filled"}
+        queue = []  # (file_path, номер чанка, текст) - ожидают пакета эмбеддингов
+
+        def embed_batch(size: int):
+            batch, queue[:] = queue[:size], queue[size:]
+            t0 = time.perf_counter()
+            vectors = self.embeddings.embed_documents([text for _, _, text in batch])
+            stats["embed"]["seconds"] += time.perf_counter() - t0
+            stats["embed"]["batches"] += 1
+
+            for (path, n, _), vector in zip(batch, vectors):
+                entry = pending[path]
+                entry["vectors"][n] = vector
+                entry["filled"] += 1
+                if entry["filled"] == len(entry["docs"]):
+                    write_db(path, pending.pop(path))
+
+        def write_db(path: str, entry: dict):
+            t0 = time.perf_counter()
+            try:
+                self._save_embedded_db(entry["db_folder"], entry["docs"], entry["vectors"])
+                stats["write"]["folders"] += 1
+                if verbose: print(f"База:  {entry['db_folder']}")
+            except Exception as e:
+                stats["errors"][path] = f"Ошибка записи базы: {str(e)}"
+            stats["write"]["seconds"] += time.perf_counter() - t0
+
+        ctx = multiprocessing.get_context("spawn")  # fork небезопасен при загруженной модели torch
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            futures = {
+                pool.submit(_parse_and_chunk_document, doc_file, self._worker_settings(), params): (doc_file, db_folder)
+                for doc_file, db_folder in jobs
+            }
+
+            parse_started = time.perf_counter()
+            for future in as_completed(futures):
+                doc_file, db_folder = futures[future]
+                try:
+                    _, docs, cpu_seconds = future.result()
+                except Exception as e:
+                    stats["errors"][doc_file] = f"Ошибка парсинга: {str(e)}"
+                    continue
+
+                stats["parse"]["cpu_seconds"] += cpu_seconds
+                if verbose: print(f"Докум: {doc_file} ({len(docs)} чанков)")
+
+                if chunks_root:
+                    category = os.path.basename(os.path.dirname(db_folder))
+                    self._dump_chunks(docs, os.path.join(chunks_root, category, os.path.basename(db_folder) + ".txt"))
+
+                if not docs:
+                    stats["errors"][doc_file] = "Нет данных для векторизации"
+                    continue
+
+                if self.is_e5_model:
+                    docs = self._add_e5_prefixes(docs)
+
+                stats["chunks"] += len(docs)
+                pending[doc_file] = {"db_folder": db_folder, "docs": docs, "vectors": [None] * len(docs), "filled": 0}
+                queue.extend((doc_file, n, doc.page_content) for n, doc in enumerate(docs))
+
+                while len(queue) >= batch_size:
+                    embed_batch(batch_size)
+
+            stats["parse"]["seconds"] = time.perf_counter() - parse_started
+
+        while queue:
+            embed_batch(batch_size)
+
+        stats["seconds"] = time.perf_counter() - started
+        stats["parse"]["docs_per_sec"] = round(len(jobs) / max(stats["parse"]["seconds"], 1e-9), 2)
+        stats["embed"]["chunks_per_sec"] = round(stats["chunks"] / max(stats["embed"]["seconds"], 1e-9), 2)
+        stats["write"]["folders_per_sec"] = round(stats["write"]["folders"] / max(stats["write"]["seconds"], 1e-9), 2)
+
+        if verbose:
+            print(f"Документов: {stats['documents']}, чанков: {stats['chunks']}, "
+                  f"общее время: {stats['seconds']:.1f} с")
+            print(f"Парсинг:     {stats['parse']['docs_per_sec']} док/с ({workers} процессов)")
+            print(f"Эмбеддинги:  {stats['embed']['chunks_per_sec']} чанков/с ({stats['embed']['batches']} пакетов)")
+            print(f"Запись:      {stats['write']['folders_per_sec']} баз/с")
+            for path, error in stats["errors"].items(): print(f"⚠️ {path}: {error}")
+
+        return stats
+
+    def _worker_settings(self) -> dict:
+        """Атрибуты, которые передаются в процессы парсинга build_databases"""
+        return {
+            "chunk_size": self.chunk_size,
+            "chunk_unit": self.chunk_unit,
+            "token_encoding": self.token_encoding,
+            "embedding_model_name": self.embedding_model_name,  # Токенизатор модели для режима токенов
+            "embedding_model_type": self.embedding_model_type,
+            "docx_backend": self.docx_backend,
+            "pdf_pages_per_job": self.pdf_pages_per_job
+        }
+
+    def _save_embedded_db(self, db_folder: str, docs: List[LangDoc], vectors: list):
+        """Создаёт FAISS-базу из готовых векторов и сохраняет её вместе с metadata.json"""
+        os.makedirs(db_folder, exist_ok=True)
+        db, index_spec = self._faiss_db_from_vectors(
+            [doc.page_content for doc in docs], vectors, [doc.metadata for doc in docs],
+            self.embeddings, self.distance_strategy, self.index_spec
+        )
+        self._save_db(db_folder, db, self.docstore_format)
+        self._save_full_vectors(db_folder, vectors, index_spec)
+        metadata = {
+            "embedding_model": self.embedding_model_name,
+            "model_type": self.embedding_model_type,
+            "dimension": len(vectors[0]),
+            "normalized": self.distance_strategy == "COSINE",
+            "distance_strategy": self.distance_strategy,
+            "is_e5_model": self.is_e5_model,
+            "index": index_spec,
+            "docstore": self.docstore_format,
+            "mmap": self.mmap_load
+        }
+        # База документа разделов не пишет (они нужны только сводной базе), устаревшие удаляются
+        metadata["partitions"], metadata["partitions_complete"] = self._write_partitions(db_folder, metadata, False)
+        self._write_metadata(db_folder, metadata)
+
+    @staticmethod
+    def _dump_chunks(docs: List[LangDoc], chunk_file: str):
+        """Пишет текстовый дамп чанков для ручной проверки"""
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+        with open(chunk_file, "w", encoding="utf-8") as file:
+            for chunk in docs:
+                file.write(f"Контент:\n{chunk.page_content}\n---\nМетаданные: {chunk.metadata}\n=====================\n")
+
     #=======================================================================
     # Загрузка базы
 
-    def faiss_loader(self, db_folder: str, hybrid_mode: bool = False) -> Dict[str, Any]:
-        """Загрузка базы с поддержкой гибридного режима."""
+    def faiss_loader(self, db_folder: str, hybrid_mode: bool = False, mmap: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Загрузка базы с поддержкой гибридного режима.
+        :param mmap: Открыть индекс через отображение в память только для чтения (см. _read_faiss_index).
+            None - как записано в metadata.json базы ("mmap")
+        """
         result = {
             "success": False,
             "db": None,
             "text_db": None,  # Только для hybrid_mode
             "table_db": None,  # Только для hybrid_mode
+            "partitions": None,  # Только для hybrid_mode
             "error": ""
         }
 
         try:
             if not hybrid_mode:
                 # Старый режим (для обратной совместимости)
-                load_result = self._single_faiss_loader(db_folder)
+                load_result = self._single_faiss_loader(db_folder, mmap=mmap)
                 if not load_result["success"]:
                     raise ValueError(load_result["error"])
                 result["db"] = load_result["db"]
             else:
-                # Гибридный режим
-                text_db_result = self._single_faiss_loader(os.path.join(db_folder, "text_db"))
-                table_db_result = self._single_faiss_loader(os.path.join(db_folder, "table_db"))
-
-                if not text_db_result["success"]:
-                    raise ValueError(f"Текстовая база: {text_db_result['error']}")
-                if not table_db_result["success"]:
-                    raise ValueError(f"Табличная база: {table_db_result['error']}")
-
-                result["text_db"] = text_db_result["db"]
-                result["table_db"] = table_db_result["db"]
+                # Гибридный режим: основная база (если есть) и её разделы text_db / table_db.
+                # Отсутствующий раздел - None. "partitions" - разделы из metadata.json (None, если база их не описывает):
+                # тогда раздела без папки нет потому, что в базе нет чанков этого типа.
+                # Если разделы покрывают все чанки (partitions_complete), основная база не загружается ("db" - None):
+                # иначе каждый чанк был бы в памяти дважды
+                _, meta = self._load_metadata(db_folder)
+                partitions = (meta or {}).get("partitions")
+                result["partitions"] = partitions
+                only_partitions = bool(partitions) and (meta or {}).get("partitions_complete", False) and all(
+                    part != "." and os.path.exists(os.path.join(db_folder, part, "index.faiss"))
+                    for part in partitions.values())
+                if not only_partitions and os.path.exists(os.path.join(db_folder, "index.faiss")):
+                    load_result = self._single_faiss_loader(db_folder, mmap=mmap)
+                    if not load_result["success"]:
+                        raise ValueError(load_result["error"])
+                    result["db"] = load_result["db"]
+
+                for element_type, folder_name in self.PARTITIONS.items():
+                    part = partitions.get(element_type) if partitions is not None else folder_name
+                    if part == ".":
+                        result[folder_name] = result["db"]
+                        continue
+                    if part is None or not os.path.exists(os.path.join(db_folder, part, "index.faiss")):
+                        continue
+                    part_result = self._single_faiss_loader(os.path.join(db_folder, part), mmap=mmap)
+                    if not part_result["success"]:
+                        raise ValueError(f"Раздел {part}: {part_result['error']}")
+                    result[folder_name] = part_result["db"]
+
+                if all(result[key] is None for key in ["db", *self.PARTITIONS.values()]):
+                    raise FileNotFoundError(f"В {db_folder} нет ни базы, ни разделов")
 
             result["success"] = True
             return result
@@ -933,7 +2860,7 @@ class DBConstructor(RAGProcessor):
                 raise FileNotFoundError(f"Папка {db_folder} не существует")
 
             # 2. Загрузка метаданных
-            meta_folders = [dir for dir, _, files in os.walk(db_folder) if files]
+            meta_folders = [dir for dir, _, files in os.walk(db_folder) if "metadata.json" in files]
 
             if verbose:
                 for each in meta_folders: print(each)
@@ -967,15 +2894,17 @@ class DBConstructor(RAGProcessor):
             pprint(result, sort_dicts=False)
         return result
 
-    def _single_faiss_loader(self, db_folder: str, verbose: bool = False) -> Dict[str, Any]:
+    def _single_faiss_loader(self, db_folder: str, verbose: bool = False, mmap: Optional[bool] = None) -> Dict[str, Any]:
         """
         Загружает FAISS-индекс.
         :param db_folder: Путь к папке с базой
-        :return: Словарь с результатами
+        :param mmap: Открыть индекс через отображение в память (None - как в metadata.json)
+        :return: Словарь с результатами; "mmap" - удалось ли отобразить векторы в память
         """
         result = {
             "success": False,
             "db": Optional[FAISS] | None,
+            "mmap": False,
             "error": ""
         }
 
@@ -985,7 +2914,9 @@ class DBConstructor(RAGProcessor):
                 raise FileNotFoundError(f"Папка {db_folder} не существует")
 
             # 2. Проверка файлов FAISS
-            required_files = ["index.faiss", "index.pkl"]
+            _, metadata = self._load_metadata(db_folder)
+            sqlite_store = (metadata or {}).get("docstore") == "sqlite"
+            required_files = ["index.faiss", ChunkStore.FILE_NAME if sqlite_store else "index.pkl"]
             missing = [f for f in required_files if not os.path.exists(os.path.join(db_folder, f))]
             if missing:
                 raise FileNotFoundError(f"Отсутствуют файлы: {missing}")
@@ -994,12 +2925,35 @@ class DBConstructor(RAGProcessor):
             if self.embeddings is None: raise EmbeddingsNotInitialized()
 
             # 3. Основная загрузка
-            result["db"] = FAISS.load_local(
-                db_folder,
-                embeddings=self.embeddings,  # Используем глобальную модель эмбеддингов
-                allow_dangerous_deserialization=True
+            if mmap is None:
+                mmap = bool((metadata or {}).get("mmap", False))
+            index, result["mmap"] = self._read_faiss_index(os.path.join(db_folder, "index.faiss"), mmap)
+            if sqlite_store:
+                # Чанки остаются на диске и читаются по id при поиске
+                store = ChunkStore(os.path.join(db_folder, ChunkStore.FILE_NAME))
+                docstore, index_to_docstore_id = store, store.id_map
+            else:
+                # То же, что делает FAISS.load_local
+                with open(os.path.join(db_folder, "index.pkl"), "rb") as f:
+                    docstore, index_to_docstore_id = pickle.load(f)
+            result["db"] = FAISS(
+                embedding_function=self.embeddings,  # Используем глобальную модель эмбеддингов
+                index=index,
+                docstore=docstore,
+                index_to_docstore_id=index_to_docstore_id
             )
 
+            # 4. Индекс chunk_id -> документ
+            self._attach_chunk_index(result["db"], db_folder)
+
+            # 5. Параметры поиска ANN-индекса (nprobe, efSearch) из metadata.json
+            if metadata:
+                self._apply_index_params(result["db"].index, metadata.get("index"))
+                # Векторы полной точности для пересчёта кандидатов квантованного индекса
+                full_path = os.path.join(db_folder, "vectors.npy")
+                if (metadata.get("index") or {}).get("rescore") and os.path.exists(full_path):
+                    result["db"].rescore_vectors = np.load(full_path, mmap_mode="r")
+
             result["success"] = True
             if verbose:
                 print(f"_single_faiss_loader: {db_folder}")
@@ -1013,12 +2967,45 @@ class DBConstructor(RAGProcessor):
             return result
 
 
+    @staticmethod
+    def _read_faiss_index(index_path: str, mmap: bool = False) -> tuple:
+        """
+        Читает index.faiss. В режиме mmap файл открывается только для чтения через отображение в память:
+        загрузка почти мгновенная, а страницы векторов делятся между процессами через кэш ОС.
+        Списки IVF отображаются в память в любой сборке FAISS; векторы плоских индексов - только если
+        сборка поддерживает IO_FLAG_MMAP_IFC, иначе они читаются в память, как обычно.
+        :return: (индекс, отображены ли векторы в память)
+        """
+        if not mmap:
+            return faiss.read_index(index_path), False
+
+        mmap_ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | mmap_ifc)
+        try:
+            faiss.extract_index_ivf(index)
+            mapped = True
+        except RuntimeError:
+            mapped = bool(mmap_ifc) and isinstance(index, faiss.IndexFlatCodes)
+        return index, mapped
+
 #============================================================
 # Объединение баз
 
-    def merge_databases(self, input_folders: List[str], output_folder: str) -> tuple:
+    def merge_databases(self,
+                        input_folders: List[str],
+                        output_folder: str,
+                        index_spec: Optional[dict] = None,
+                        docstore_format: Optional[str] = None,
+                        partitions: Optional[bool] = None) -> tuple:
         """
-        Объединяет несколько FAISS-баз с проверкой совместимости
+        Объединяет несколько FAISS-баз с проверкой совместимости.
+        Работает напрямую с файлами index.faiss и index.pkl: модель эмбеддингов не загружается,
+        базы читаются по одной и пакетами добавляются в итоговый индекс (см. _stream_merge_folders).
+        Если у сжатой базы нет vectors.npy, её векторы восстанавливаются с потерями - об этом
+        печатается предупреждение и оно добавляется в сообщение результата.
+        :param index_spec: Тип индекса результата (см. _resolve_index_spec). По умолчанию - тип первой базы
+        :param docstore_format: Хранилище чанков результата, "pickle" или "sqlite". По умолчанию self.docstore_format
+        :param partitions: Записать разделы text_db / table_db (см. _write_partitions). По умолчанию self.partition_bases
         Возвращает (success: bool, message: str)
         """
         try:
@@ -1036,18 +3023,30 @@ class DBConstructor(RAGProcessor):
                     msg = f"Несовместимые базы:\n{main_meta['embedding_model']}\nи\n{current_meta['embedding_model']}"
                     return False, msg
 
-            # 4. Загрузка эмбеддингов
-            err_code, embeddings = self._load_embeddings(main_meta)
-            if not embeddings: return False, err_code
+            # 4. Тип индекса: по умолчанию как у первой базы, число кластеров пересчитывается под новый объём
+            if index_spec is None:
+                index_spec = {k: v for k, v in (main_meta.get("index") or {}).items() if k != "nlist"}
 
-            # 5. Объединение баз
-            merged_db = self._merge_faiss_indexes(input_folders, embeddings)
+            # 5. Потоковое объединение баз сразу в индекс нужного типа
+            index, documents, index_to_docstore_id, index_spec, warnings = self._stream_merge_folders(
+                input_folders, index_spec, main_meta["distance_strategy"], output_folder)
+            for warning in warnings:
+                print(f"⚠️ {warning}")
 
             # 6. Сохранение результата
-            merged_db.save_local(output_folder)
-            self._save_merged_metadata(output_folder, main_meta)
-
-            return True, f"Базы успешно объединены в {output_folder}"
+            docstore_format = docstore_format or self.docstore_format
+            self._write_faiss_folder(output_folder, index, documents, index_to_docstore_id, docstore_format)
+            if not index_spec.get("rescore"):
+                self._save_full_vectors(output_folder, None, index_spec)
+            merged_meta = {**main_meta, "index": index_spec, "docstore": docstore_format}
+            merged_meta["partitions"], merged_meta["partitions_complete"] = self._write_partitions(
+                output_folder, merged_meta, self.partition_bases if partitions is None else partitions)
+            self._save_merged_metadata(output_folder, merged_meta)
+
+            message = f"Базы успешно объединены в {output_folder}"
+            if warnings:
+                message += ". Предупреждения: " + "; ".join(warnings)
+            return True, message
 
         except Exception as e:
             return False, f"Критическая ошибка: {str(e)}"
@@ -1144,17 +3143,17 @@ class DBConstructor(RAGProcessor):
             model_type = metadata['model_type']
             model_name = metadata['embedding_model']
             if metadata['model_type'] == "openai":
-                return "Успешно", OpenAIEmbeddings(
+                return "Успешно", self._with_cache(OpenAIEmbeddings(
                     model=model_name,
                     api_key=self.api_key,
                     base_url=self.api_url
-                )
+                ), model_name, metadata['normalized'])
 
             elif metadata['model_type'] == "huggingface":
-                return "Успешно", HuggingFaceEmbeddings(
+                return "Успешно", self._with_cache(HuggingFaceEmbeddings(
                     model_name=model_name,
                     encode_kwargs={'normalize_embeddings': metadata['normalized']}
-                )
+                ), model_name, metadata['normalized'])
             else:
                 raise ValueError(f"Неподдерживаемый тип модели: {model_type}. Доступные варианты: openai, huggingface")
 
@@ -1168,16 +3167,254 @@ class DBConstructor(RAGProcessor):
         except Exception as e:
             return f"Неизвестная ошибка при загрузке эмбеддингов: {str(e)}", None
 
+    MERGE_BATCH = 65_536  # Векторов за один add при объединении баз
+
+    @staticmethod
+    def _is_lossless_index(index) -> bool:
+        """Восстанавливает ли индекс векторы без потерь (плоское хранение float32)"""
+        index = faiss.downcast_index(index)
+        return isinstance(index, (faiss.IndexFlat, faiss.IndexHNSWFlat, faiss.IndexIVFFlat))
+
+    @classmethod
+    def _open_folder_vectors(cls, folder: str) -> Tuple[Any, Callable[[int, int], np.ndarray], bool]:
+        """
+        Векторы сохранённой базы по диапазонам номеров: из vectors.npy (memmap), если он есть, иначе из индекса.
+        :return: (индекс, функция (start, stop) -> векторы float32, векторы точные)
+        """
+        index = faiss.read_index(os.path.join(folder, "index.faiss"))
+        full_path = os.path.join(folder, "vectors.npy")
+        if os.path.exists(full_path):
+            full_vectors = np.load(full_path, mmap_mode="r")
+            return index, lambda start, stop: np.ascontiguousarray(full_vectors[start:stop], dtype=np.float32), True
+        try:
+            faiss.extract_index_ivf(index).make_direct_map()
+        except RuntimeError:
+            pass
+        return index, lambda start, stop: index.reconstruct_n(start, stop - start), cls._is_lossless_index(index)
+
+    @classmethod
+    def _stream_merge_folders(cls, folders: List[str], index_spec: Optional[dict], distance_strategy: str,
+                              output_folder: str) -> Tuple[Any, Dict[str, LangDoc], Dict[int, str], dict, List[str]]:
+        """
+        N-way объединение баз без langchain и модели эмбеддингов. Базы читаются по одной:
+        1) размеры и точность векторов; 2) для обучаемых индексов - равномерная выборка для обучения
+        (не больше _train_size); 3) векторы источника пакетами по MERGE_BATCH добавляются сразу в итоговый
+        индекс, при rescore - в output_folder/vectors.npy. Полной копии всех векторов в памяти не создаётся.
+        Хранилище каждой базы должно занимать номера 0..ntotal-1 без пропусков.
+        :return: (индекс, {id: документ}, {номер вектора: id}, итоговая спецификация индекса, предупреждения)
+        """
+        sizes, warnings = [], []
+        dimension = metric = None
+        for folder in folders:
+            index, _, exact = cls._open_folder_vectors(folder)
+            if dimension is None:
+                dimension, metric = index.d, index.metric_type
+            elif (index.d, index.metric_type) != (dimension, metric):
+                raise ValueError(f"База {folder} отличается размерностью или метрикой индекса")
+            sizes.append(index.ntotal)
+            if not exact:
+                warnings.append(f"{folder}: нет vectors.npy, векторы восстановлены из сжатого индекса с потерями")
+            del index
+        total = sum(sizes)
+
+        if cls._is_flat_spec(index_spec):
+            resolved = {"type": "flat"}
+            flat_type = faiss.IndexFlatIP if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2
+            merged_index = flat_type(dimension)
+        else:
+            resolved = cls._resolve_index_spec(index_spec, total, dimension)
+            train = np.empty((0, dimension), dtype=np.float32)
+            train_size = min(total, cls._train_size(resolved))
+            if train_size:
+                # Равномерная по номерам выборка из всех баз
+                wanted = np.unique(np.linspace(0, total - 1, train_size).astype(np.int64))
+                parts, offset = [], 0
+                for folder, size in zip(folders, sizes):
+                    local = wanted[(wanted >= offset) & (wanted < offset + size)] - offset
+                    if len(local):
+                        index, read, _ = cls._open_folder_vectors(folder)
+                        parts.append(read(0, size)[local] if len(local) * 4 > size
+                                      else np.vstack([read(int(i), int(i) + 1) for i in local]))
+                        del index
+                    offset += size
+                train = np.vstack(parts)
+            merged_index = cls._build_faiss_index(resolved, dimension, distance_strategy, train)
+            del train
+
+        full_vectors = None
+        if resolved.get("rescore"):
+            os.makedirs(output_folder, exist_ok=True)
+            full_vectors = np.lib.format.open_memmap(os.path.join(output_folder, "vectors.npy"), mode="w+",
+                                                     dtype=np.float32, shape=(total, dimension))
+
+        documents, index_to_docstore_id = {}, {}
+        for folder, size in zip(folders, sizes):
+            offset = merged_index.ntotal
+            positions = []
+            for i, doc in cls.iter_folder_docstore(folder):
+                if doc.id in documents:
+                    raise ValueError(f"Повторяющийся id документа {doc.id} в {folder}")
+                positions.append(i)
+                documents[doc.id] = doc
+                index_to_docstore_id[offset + i] = doc.id
+            if sorted(positions) != list(range(size)):
+                raise ValueError(f"Хранилище {folder} не совпадает с индексом: номера векторов не 0..{size - 1}")
+
+            index, read, _ = cls._open_folder_vectors(folder)
+            for start in range(0, size, cls.MERGE_BATCH):
+                stop = min(size, start + cls.MERGE_BATCH)
+                vectors = read(start, stop)
+                merged_index.add(vectors)
+                if full_vectors is not None:
+                    full_vectors[offset + start:offset + stop] = vectors
+            del index, read
+
+        if full_vectors is not None:
+            full_vectors.flush()
+            del full_vectors
+        return merged_index, documents, index_to_docstore_id, resolved, warnings
+
+    @staticmethod
+    def _write_faiss_folder(folder: str,
+                            index,
+                            documents: Dict[str, LangDoc],
+                            index_to_docstore_id: Dict[int, str],
+                            docstore_format: str = "pickle"):
+        """
+        Сохраняет индекс и документы: index.faiss + index.pkl (формат FAISS.save_local) и chunk_index.json
+        (ChunkIndex) или index.faiss + chunks.sqlite (ChunkStore, индекс чанков - в его столбцах).
+        Файлы другого формата удаляются.
+        """
+        if docstore_format not in ("pickle", "sqlite"):
+            raise ValueError(f"Неподдерживаемый формат хранилища чанков: {docstore_format}")
+        os.makedirs(folder, exist_ok=True)
+        faiss.write_index(index, os.path.join(folder, "index.faiss"))
+        pkl_path = os.path.join(folder, "index.pkl")
+        sqlite_path = os.path.join(folder, ChunkStore.FILE_NAME)
+        chunk_index_path = os.path.join(folder, ChunkIndex.FILE_NAME)
+        if docstore_format == "sqlite":
+            ChunkStore.write(sqlite_path, documents, index_to_docstore_id)
+            stale_paths = [pkl_path, chunk_index_path]
+        else:
+            with open(pkl_path, "wb") as f:
+                pickle.dump((InMemoryDocstore(documents), index_to_docstore_id), f)
+            ordered_ids = [doc_id for _, doc_id in sorted(index_to_docstore_id.items())]
+            ChunkIndex.build((doc_id, documents[doc_id]) for doc_id in ordered_ids).save(folder)
+            stale_paths = [sqlite_path]
+        for stale_path in stale_paths:
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        articles_path = os.path.join(folder, "articles.json")  # Прежний файл с полными текстами статей
+        if os.path.exists(articles_path):
+            os.remove(articles_path)
+
+    def _save_db(self, db_folder: str, db: FAISS, docstore_format: str = "pickle"):
+        """Сохраняет собранную в памяти базу в нужном формате хранилища чанков"""
+        self._write_faiss_folder(db_folder, db.index, db.docstore._dict, db.index_to_docstore_id, docstore_format)
+
+    @staticmethod
+    def iter_folder_docstore(folder: str) -> Generator[Tuple[int, LangDoc], None, None]:
+        """Пары (номер вектора, документ) сохранённой базы в любом формате хранилища, без загрузки индекса"""
+        sqlite_path = os.path.join(folder, ChunkStore.FILE_NAME)
+        if os.path.exists(sqlite_path):
+            store = ChunkStore(sqlite_path)
+            try:
+                yield from store.iter_documents()
+            finally:
+                store.close()
+            return
+        with open(os.path.join(folder, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        for i, doc_id in sorted(index_to_docstore_id.items()):
+            doc = docstore.search(doc_id)
+            if doc.id is None:
+                doc = LangDoc(id=doc_id, page_content=doc.page_content, metadata=doc.metadata)
+            yield i, doc
+
+    #=======================================================================
+    # Поиск чанков по chunk_id / doc_id
+
+    @staticmethod
+    def _attach_chunk_index(db: FAISS, db_folder: str):
+        """
+        Индекс чанков базы: у хранилища SQLite - его индексированные столбцы (ChunkStoreIndex), иначе
+        chunk_index.json. Для старых баз без них (или со старым форматом) индекс строится по docstore.
+        """
+        if isinstance(db.docstore, ChunkStore) and db.docstore.has_keys:
+            db.chunk_index = ChunkStoreIndex(db.docstore)
+            return
+        chunk_index = ChunkIndex.load(db_folder)
+        if chunk_index is None:
+            chunk_index = ChunkIndex.build((doc_id, db.docstore.search(doc_id))
+                                           for _, doc_id in sorted(db.index_to_docstore_id.items()))
+        db.chunk_index = chunk_index
+
+    @staticmethod
+    def list_documents(indexes: List[Optional[FAISS]]) -> Dict[str, str]:
+        """
+        Документы загруженных баз: doc_id -> название. В сводной базе категории документы различаются
+        только метаданными, и поиск по одному документу - это фильтр {"doc_id": ...}, а не отдельная база
+        """
+        documents = {}
+        for db in indexes:
+            chunk_index = getattr(db, "chunk_index", None)
+            if chunk_index is None:
+                continue
+            for doc_id in chunk_index.docs:
+                documents.setdefault(doc_id, chunk_index.titles.get(doc_id, f"Документ {doc_id}"))
+        return documents
+
     @staticmethod
-    def _merge_faiss_indexes(folders: List[str], embeddings: Embeddings) -> FAISS:
-        """Объединяет FAISS-индексы"""
-        merged_db = FAISS.load_local(folders[0], embeddings, allow_dangerous_deserialization=True)
+    def find_article(group_id: str, indexes: List[Optional[FAISS]]) -> Optional[dict]:
+        """
+        Статья по group_id - в первой из баз, где она есть: {"chunk_ids", "text", "doc_id", "_title", "element_type"}.
+        Куски читаются из docstore по chunk_index, текст склеивается без префиксов E5 - как его собирает бот.
+        """
+        for db in indexes:
+            chunk_index = getattr(db, "chunk_index", None)
+            chunk_ids = chunk_index.groups.get(group_id) if chunk_index is not None else None
+            if not chunk_ids:
+                continue
+            chunks = [chunk for chunk in (DBConstructor.get_chunk(db, chunk_id) for chunk_id in chunk_ids) if chunk]
+            if not chunks:
+                continue
+            return {
+                "chunk_ids": chunk_ids,
+                "text": "\n\n".join(re.sub(r'^(passage|query):\s*', '', chunk.page_content).strip() for chunk in chunks),
+                "doc_id": chunks[0].metadata.get("doc_id"),
+                "_title": chunks[0].metadata.get("_title"),
+                "element_type": chunks[0].metadata.get("element_type", "text")
+            }
+        return None
 
-        for folder in folders[1:]:
-            current_db = FAISS.load_local(folder, embeddings, allow_dangerous_deserialization=True)
-            merged_db.merge_from(current_db)
+    @staticmethod
+    def get_chunk(db: FAISS, chunk_id: str) -> Optional[LangDoc]:
+        """Чанк базы по chunk_id за O(1) (по chunk_index базы)"""
+        chunk_index = getattr(db, "chunk_index", None)
+        if chunk_index is None:
+            return None
+        docstore_id = chunk_index.chunks.get(chunk_id)
+        if docstore_id is None:
+            return None
+        doc = db.docstore.search(docstore_id)
+        return doc if isinstance(doc, LangDoc) else None
+
+    def find_chunk(self, chunk_id: str, indexes: List[Optional[FAISS]]) -> Optional[LangDoc]:
+        """Чанк по chunk_id в первой из баз, где он есть"""
+        for db in indexes:
+            if db is not None:
+                chunk = self.get_chunk(db, chunk_id)
+                if chunk is not None:
+                    return chunk
+        return None
 
-        return merged_db
+    def get_document_chunks(self, db: FAISS, doc_id: Any) -> List[LangDoc]:
+        """Все чанки документа doc_id в порядке индекса"""
+        chunk_index = getattr(db, "chunk_index", None)
+        if chunk_index is None:
+            return []
+        return [chunk for chunk_id in chunk_index.docs.get(str(doc_id), [])
+                if (chunk := self.get_chunk(db, chunk_id)) is not None]
 
     @staticmethod
     def _save_merged_metadata(output_folder: str, meta: dict):
@@ -1188,7 +3425,12 @@ class DBConstructor(RAGProcessor):
             "dimension": meta["dimension"],
             "normalized": meta["normalized"],
             "distance_strategy": meta["distance_strategy"],
-            "is_e5_model": meta["is_e5_model"]
+            "is_e5_model": meta["is_e5_model"],
+            "index": meta.get("index", {"type": "flat"}),
+            "docstore": meta.get("docstore", "pickle"),
+            "mmap": meta.get("mmap", False),
+            "partitions": meta.get("partitions"),
+            "partitions_complete": meta.get("partitions_complete", False)
         }
 
         with open(os.path.join(output_folder, "metadata.json"), "w") as f:
@@ -1196,19 +3438,29 @@ class DBConstructor(RAGProcessor):
 
 # ==================================================================================================
 # Поиск
-    @staticmethod
-    def formatted_scored_sim_search_by_cos(index: Optional[FAISS], query: str, **search_args) -> list:
+    def formatted_scored_sim_search_by_cos(self,
+                                           index: Optional[FAISS],
+                                           query: str,
+                                           query_embedding: Optional[List[float]] = None,
+                                           **search_args) -> list:
         """
         Cинхронный поиск на базе similarity_search_with_relevance_scores.
         :param index: FAISS-индекс из langchain
-        :param query: Запрос (вектор)
+        :param query: Запрос (строка)
+        :param query_embedding: Готовый вектор запроса. По умолчанию - embed_query(query)
         :param k:
         :return: список словарей с результатами поиска
         """
         k = search_args.pop("k", 4)
         kwargs = search_args.copy()
-        # Стандартный поиск по совпадению на основе косинусных расстояний который возвращает
-        results = index.similarity_search_with_relevance_scores(query, k=k, **kwargs)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        if getattr(index, "rescore_vectors", None) is not None:
+            # Квантованный индекс: кандидаты пересчитываются по векторам полной точности
+            results = self._rescored_search_with_scores(index, query_embedding, k=k, **kwargs)
+        else:
+            # Стандартный поиск по совпадению на основе косинусных расстояний который возвращает
+            results = self._relevance_search_by_vector(index, query_embedding, k=k, **kwargs)
         # Преобразуем результаты в требуемый формат
         formatted_results = []
         for doc, score in results:
@@ -1219,19 +3471,72 @@ class DBConstructor(RAGProcessor):
             })
         return formatted_results
 
+    RESCORE_FACTOR = 4  # Во сколько раз больше кандидатов берётся из квантованного индекса для пересчёта
+
+    @staticmethod
+    def _relevance_search_by_vector(index: FAISS, query_embedding: List[float], k: int = 4,
+                                    **kwargs) -> List[Tuple[LangDoc, float]]:
+        """similarity_search_with_relevance_scores langchain для готового вектора запроса"""
+        score_threshold = kwargs.pop("score_threshold", None)
+        relevance_fn = index._select_relevance_score_fn()
+        results = [(doc, relevance_fn(score))
+                   for doc, score in index.similarity_search_with_score_by_vector(query_embedding, k=k, **kwargs)]
+        if score_threshold is not None:
+            results = [(doc, score) for doc, score in results if score >= score_threshold]
+        return results
+
+    @staticmethod
+    def _rescored_search_with_scores(index: FAISS, query_embedding: List[float], k: int = 4,
+                                     **kwargs) -> List[Tuple[LangDoc, float]]:
+        """
+        Поиск по квантованному индексу с пересчётом кандидатов в полной точности.
+        Из индекса берётся fetch_k кандидатов (по умолчанию k * RESCORE_FACTOR), их расстояния до запроса
+        считаются заново по index.rescore_vectors, оценки нормируются так же, как в
+        similarity_search_with_relevance_scores.
+        """
+        score_threshold = kwargs.pop("score_threshold", None)
+        fetch_k = kwargs.pop("fetch_k", k * DBConstructor.RESCORE_FACTOR)
+        embedding = np.asarray(query_embedding, dtype=np.float32)
+        candidates = index.similarity_search_with_score_by_vector(embedding.tolist(), k=fetch_k, **kwargs)
+        if not candidates:
+            return []
+
+        positions = getattr(index, "rescore_positions", None)
+        if positions is None or len(positions) != len(index.index_to_docstore_id):
+            positions = index.rescore_positions = {doc_id: i for i, doc_id in index.index_to_docstore_id.items()}
+        vectors = np.asarray(index.rescore_vectors[[positions[doc.id] for doc, _ in candidates]])
+        if index.distance_strategy == "MAX_INNER_PRODUCT":
+            distances = vectors @ embedding
+            order = np.argsort(-distances)
+        else:
+            distances = ((vectors - embedding) ** 2).sum(axis=1)
+            order = np.argsort(distances)
+
+        relevance_fn = index._select_relevance_score_fn()
+        results = [(candidates[i][0], relevance_fn(float(distances[i]))) for i in order[:k]]
+        if score_threshold is not None:
+            results = [(doc, score) for doc, score in results if score >= score_threshold]
+        return results
+
     # Синхронный поиск по максимальной предельной релевантности с очками
-    def formatted_scored_mmr_search_by_vector(self, index: Optional[FAISS], query: str, **search_args: Any) -> list:
+    def formatted_scored_mmr_search_by_vector(self,
+                                              index: Optional[FAISS],
+                                              query: str,
+                                              query_embedding: Optional[List[float]] = None,
+                                              **search_args: Any) -> list:
         """
         Cинхронный поиск на базе max_marginal_relevance_search_with_score_by_vector.
         :param index: FAISS-индекс из langchain
-        :param query: Запрос (вектор)
+        :param query: Запрос (строка)
+        :param query_embedding: Готовый вектор запроса. По умолчанию - embed_query(query)
         :param k:
         :return: список словарей с результатами поиска
         """
         if index is None: return []
 
         # Получение эмбеддинга запроса
-        query_embedding = self.embeddings.embed_query(query)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
         # MMR поиск с исходными оценками
         results = index.max_marginal_relevance_search_with_score_by_vector(
             query_embedding,
@@ -1249,6 +3554,44 @@ class DBConstructor(RAGProcessor):
 
         return formatted_results
 
+    # --------------------------------------------------
+    # Векторы запросов
+
+    def embed_query(self, query: str) -> List[float]:
+        """Вектор запроса через кэш недавних запросов (QueryEmbeddingCache)"""
+        self.query_cache.bind(self.embeddings)
+        key = self.query_cache.normalize(query)
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(key)
+            self.query_cache.put(key, vector)
+        return vector
+
+    async def aembed_query(self, query: str) -> List[float]:
+        """
+        Асинхронный embed_query. Одинаковые запросы, пришедшие одновременно, ждут одно вычисление модели,
+        разные - собираются в батчи EmbeddingBatcher (embed_batch_window, embed_batch_size).
+        """
+        self.query_cache.bind(self.embeddings)
+        key = self.query_cache.normalize(query)
+        vector = self.query_cache.get(key)
+        if vector is not None:
+            return vector
+
+        task = self._query_inflight.get(key)
+        if task is None:
+            batcher = self.embedding_batcher
+            if (batcher is None or batcher.embeddings is not self.embeddings
+                    or (batcher.window, batcher.max_batch) != (self.embed_batch_window, self.embed_batch_size)):
+                batcher = self.embedding_batcher = EmbeddingBatcher(
+                    self.embeddings, window=self.embed_batch_window, max_batch=self.embed_batch_size)
+            task = asyncio.ensure_future(batcher.embed(key))
+            self._query_inflight[key] = task
+            task.add_done_callback(lambda _: self._query_inflight.pop(key, None))
+        vector = await asyncio.shield(task)
+        self.query_cache.put(key, vector)
+        return vector
+
     # --------------------------------------------------
     # Асинхронный поиск
 
@@ -1261,43 +3604,105 @@ class DBConstructor(RAGProcessor):
     def aformatted_scored_mmr_search_by_vector(self, index: Optional[FAISS], query: str, **search_args) -> list:
         return self.formatted_scored_mmr_search_by_vector(index, query, **search_args)
 
-    async def aformatted_scored_mrr_search_with_cosine_sorting(self, index: FAISS, query: str, **search_args) -> list:
-        # 1. Асинхронно получаем вектор запроса
-        query_embedding = await self.embeddings.aembed_query(query)
-
-        # 2. Синхронный MMR-поиск (FAISS не поддерживает асинхрон)
-        results = index.max_marginal_relevance_search_by_vector(
-            embedding=query_embedding,
-            **search_args
-        )
-
-        # 3. Параллельная векторизация документов
-        embedding_tasks = [
-            self._get_doc_emb(doc.page_content, n)
-            for n, doc in enumerate(results)
-        ]
-        doc_embeddings = await asyncio.gather(*embedding_tasks)
+    async def aformatted_scored_mrr_search_with_cosine_sorting(self,
+                                                               index: FAISS,
+                                                               query: str,
+                                                               query_embedding: Optional[List[float]] = None,
+                                                               **search_args) -> list:
+        # 1. Асинхронно получаем вектор запроса (если его не передали готовым)
+        if query_embedding is None:
+            query_embedding = await self.aembed_query(query)
+
+        # 2. MMR-поиск и косинусные оценки по векторам из индекса (FAISS не поддерживает асинхрон)
+        return await asyncio.to_thread(self.mmr_search_with_cosine_sorting, index, query_embedding, **search_args)
+
+    def mmr_search_with_cosine_sorting(self,
+                                       index: FAISS,
+                                       query_embedding: List[float],
+                                       k: int = 4,
+                                       fetch_k: int = 20,
+                                       lambda_mult: float = 0.5,
+                                       filter: Optional[dict] = None) -> list:
+        """
+        MMR-поиск с сортировкой результатов по косинусному сходству с запросом.
+        Векторы кандидатов берутся из самого индекса (или из vectors.npy квантованной базы), модель
+        эмбеддингов повторно не вызывается; MMR и косинусы считаются одним матричным проходом NumPy.
+        Отбор совпадает с max_marginal_relevance_search_by_vector из langchain.
+        :param query_embedding: Вектор запроса
+        :return: список словарей с результатами поиска, по убыванию сходства
+        """
+        positions, docs = self._mmr_candidates(index, query_embedding, fetch_k, filter)
+        if not docs:
+            return []
+
+        candidates = self._normalized(self._stored_vectors(index, positions))
+        query = self._normalized(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
+        query_similarity = candidates @ query
+
+        selected = self._mmr_select(candidates, query_similarity, k, lambda_mult)
+        formatted_results = [{
+            "content": docs[i].page_content,
+            "score": float(query_similarity[i]),
+            "metadata": docs[i].metadata
+        } for i in selected]
+
+        # Сортировка по убыванию сходства
+        return sorted(formatted_results, key=lambda x: x["score"], reverse=True)
 
-        # 4. Расчет косинусных сходств
-        formatted_results = []
-        query_norm = np.linalg.norm(query_embedding)
-        for doc, doc_emb in zip(results, doc_embeddings):
-            doc_norm = np.linalg.norm(doc_emb)
-            cosine_sim = np.dot(query_embedding, doc_emb) / (query_norm * doc_norm)
+    @staticmethod
+    def _mmr_candidates(index: FAISS, query_embedding: List[float], fetch_k: int,
+                        filter: Optional[dict]) -> Tuple[List[int], List[LangDoc]]:
+        """Кандидаты MMR: номера векторов и документы (с фильтром - как в langchain, из fetch_k * 2)"""
+        vector = np.asarray([query_embedding], dtype=np.float32)
+        if index._normalize_L2:
+            faiss.normalize_L2(vector)
+        _, indices = index.index.search(vector, fetch_k if filter is None else fetch_k * 2)
+        filter_func = index._create_filter_func(filter) if filter is not None else None
+
+        positions, docs = [], []
+        for i in indices[0]:
+            if i == -1:
+                continue
+            doc = index.docstore.search(index.index_to_docstore_id[i])
+            if not isinstance(doc, LangDoc):
+                raise ValueError(f"Could not find document for id {index.index_to_docstore_id[i]}, got {doc}")
+            if filter_func is None or filter_func(doc.metadata):
+                positions.append(int(i))
+                docs.append(doc)
+        return positions, docs
 
-            formatted_results.append({
-                "content": doc.page_content,
-                "score": cosine_sim,
-                "metadata": doc.metadata
-            })
+    @staticmethod
+    def _stored_vectors(index: FAISS, positions: List[int]) -> np.ndarray:
+        """Сохранённые векторы по номерам: полной точности из vectors.npy, если есть, иначе из индекса"""
+        full_vectors = getattr(index, "rescore_vectors", None)
+        if full_vectors is not None:
+            return np.asarray(full_vectors[positions], dtype=np.float32)
+        return index.index.reconstruct_batch(np.asarray(positions, dtype=np.int64))
 
-        # 5. Сортировка по убыванию сходства
-        return sorted(formatted_results, key=lambda x: x["score"], reverse=True)
+    @staticmethod
+    def _normalized(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
 
-    @async_wrapper
-    def _get_doc_emb(self, doc: str, n: int):
-        out = self.embeddings.embed_query(doc)
-        return out
+    @staticmethod
+    def _mmr_select(candidates: np.ndarray, query_similarity: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+        """
+        Максимальная предельная релевантность по нормированным векторам кандидатов.
+        Для каждого кандидата хранится максимум сходства с уже выбранными, поэтому шаг отбора - O(кандидатов).
+        """
+        k = min(k, len(candidates))
+        if k <= 0:
+            return []
+        selected = [int(np.argmax(query_similarity))]
+        max_redundancy = candidates @ candidates[selected[0]]
+        while len(selected) < k:
+            scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_redundancy
+            scores[selected] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            max_redundancy = np.maximum(max_redundancy, candidates @ candidates[best])
+        return selected
 
     async def multi_async_search(
             self,
@@ -1308,11 +3713,26 @@ class DBConstructor(RAGProcessor):
     ) -> list:
         """
         Асинхронный поиск по нескольким индексам с одним запросом.
+        Вектор запроса считается один раз и передаётся во все поиски (query_embedding).
+        Поиск по сходству (aformatted_scored_sim_search_by_cos) идёт через multi_index_search, остальные
+        функции (MMR) вызываются для каждого индекса.
         :param query: Запрос (строка)
         :param indexes: Список FAISS-индексов
         :param search_function: Асинхронная функция поиска
         :return: список словарей с результатами поиска
         """
+        if search_args.get("query_embedding") is None:
+            search_args["query_embedding"] = await self.aembed_query(query)
+        if (search_function == self.aformatted_scored_sim_search_by_cos
+                and set(search_args) <= {"query_embedding", "k", "filter", "fetch_k", "score_threshold"}):
+            # Поиск по сходству: все индексы одним вызовом multi_index_search (общий top-k, а не k с каждого индекса)
+            embedding = search_args.pop("query_embedding")
+            try:
+                results = await asyncio.to_thread(self.multi_index_search, indexes, [embedding], **search_args)
+            except Exception as e:
+                print(f"⚠️ Ошибка в поиске: {str(e)}")
+                return []
+            return [{key: value for key, value in res.items() if key != "index"} for res in results[0]]
         tasks = [search_function(index, query, **search_args) for index in indexes]
         results = await asyncio.gather(*tasks, return_exceptions=True)
         valid_results = []
@@ -1324,6 +3744,231 @@ class DBConstructor(RAGProcessor):
                 valid_results.extend(res)
         return valid_results
 
+    async def alayered_search(self,
+                              query: str,
+                              indexes: List[Optional[FAISS]],
+                              search_function: Callable,
+                              layers: List[dict],
+                              total_k: Optional[int] = None,
+                              extra_filter: Optional[dict] = None,
+                              partitions: Optional[Dict[str, List[FAISS]]] = None) -> Tuple[list, dict]:
+        """
+        Послойный поиск: каждый слой (свой фильтр по метаданным и свои параметры поиска) ищется по всем
+        индексам одновременно с остальными слоями, вектор запроса считается один раз.
+        Слой - словарь вида {"element_type": "table", "_search_params": {"k": 3, ...}, "_quota": 1, "_name": "table"}:
+        ключи без "_" - фильтр, "_quota" - сколько результатов слой даёт в итог (по умолчанию его k).
+        Если задан total_k и слоям не хватило результатов на свои квоты, остаток добирается лучшими
+        из невошедших результатов любых слоёв.
+        :param extra_filter: Условия, добавляемые к фильтру каждого слоя (например, {"doc_id": [...]})
+        :param partitions: {element_type: индексы разделов} (см. faiss_loader с hybrid_mode). Слой с таким
+            element_type ищется по разделу без условия на element_type - точный поиск без лишних кандидатов
+        :return: (результаты по убыванию оценки, {имя слоя: {"ms", "found", "kept", "partition"}})
+        """
+        query_embedding = await self.aembed_query(query)
+
+        def route(layer: dict) -> Tuple[List[Optional[FAISS]], dict]:
+            layer_filter = {**{k: v for k, v in layer.items() if not k.startswith("_")}, **(extra_filter or {})}
+            element_type = layer_filter.get("element_type")
+            if partitions is not None and isinstance(element_type, str) and element_type in partitions:
+                del layer_filter["element_type"]
+                return partitions[element_type], layer_filter
+            return indexes, layer_filter
+
+        async def run_layer(layer_indexes: List[Optional[FAISS]], layer_filter: dict, layer: dict):
+            started = time.perf_counter()
+            found = []
+            if layer_indexes:
+                found = await self.multi_async_search(query, layer_indexes, search_function,
+                                                      query_embedding=query_embedding,
+                                                      filter=layer_filter or None, **layer.get("_search_params", {}))
+            return found, round(1000 * (time.perf_counter() - started), 1)
+
+        routes = [route(layer) for layer in layers]
+        outcomes = await asyncio.gather(*(run_layer(*routed, layer) for routed, layer in zip(routes, layers)))
+
+        merged, leftovers, seen, report = [], [], set(), {}
+        for number, (layer, (layer_indexes, _), (found, elapsed)) in enumerate(zip(layers, routes, outcomes)):
+            name = layer.get("_name", layer.get("element_type", str(number)))
+            quota = layer.get("_quota", layer.get("_search_params", {}).get("k", 4))
+            kept = 0
+            for result in sorted(found, key=lambda r: r["score"], reverse=True):
+                key = result["metadata"].get("chunk_id", result["content"])
+                if key in seen:
+                    continue
+                if kept < quota:
+                    seen.add(key)
+                    merged.append(result)
+                    kept += 1
+                else:
+                    leftovers.append((key, result))
+            report[name] = {"ms": elapsed, "found": len(found), "kept": kept, "partition": layer_indexes is not indexes}
+
+        if total_k is not None:
+            for key, result in sorted(leftovers, key=lambda item: item[1]["score"], reverse=True):
+                if len(merged) >= total_k:
+                    break
+                if key not in seen:
+                    seen.add(key)
+                    merged.append(result)
+
+        return sorted(merged, key=lambda r: r["score"], reverse=True), report
+
+    async def amulti_index_search(self,
+                                  queries: Union[str, List[str]],
+                                  indexes: List[Optional[FAISS]],
+                                  k: int = 4,
+                                  **search_args) -> list:
+        """
+        Асинхронный multi_index_search: векторы запросов считаются через aembed_query, поиск - в отдельном потоке.
+        :param queries: Запрос или список запросов
+        :return: для одного запроса - список результатов, для списка - список списков
+        """
+        single = isinstance(queries, str)
+        queries = [queries] if single else queries
+        embeddings = await asyncio.gather(*(self.aembed_query(query) for query in queries))
+        results = await asyncio.to_thread(self.multi_index_search, indexes, embeddings, k, **search_args)
+        return results[0] if single else results
+
+    def multi_index_search(self,
+                           indexes: List[Optional[FAISS]],
+                           query_embeddings: Union[List[List[float]], np.ndarray],
+                           k: int = 4,
+                           filter: Optional[Union[Callable, dict]] = None,
+                           fetch_k: int = 20,
+                           score_threshold: Optional[float] = None) -> List[List[dict]]:
+        """
+        Поиск top-k сразу по нескольким индексам для матрицы запросов.
+        Совместимые индексы (одна размерность, метрика и нормализация) объединяются в faiss.IndexShards
+        и получают всю матрицу одним вызовом search (см. _search_group); квантованные индексы с пересчётом (rescore_vectors)
+        ищутся отдельно. Кандидаты групп сливаются ограниченной кучей размера k.
+        :param indexes: Список FAISS-индексов
+        :param query_embeddings: Векторы запросов (строки матрицы)
+        :param k: Сколько результатов вернуть на запрос
+        :param filter: Фильтр по метаданным, как в FAISS langchain (тогда из индексов берётся fetch_k кандидатов)
+        :param fetch_k: Кандидатов на запрос при фильтрации
+        :param score_threshold: Минимальная оценка
+        :return: для каждого запроса - список словарей content/score/metadata/index (позиция индекса в indexes),
+        отсортированный по убыванию оценки
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries.reshape(1, -1) if queries.ndim == 1 else queries
+        streams = [[] for _ in range(len(queries))]
+
+        groups = {}
+        for position, index in enumerate(indexes):
+            if index is None or index.index.ntotal == 0:
+                continue
+            if getattr(index, "rescore_vectors", None) is not None:
+                for row, embedding in enumerate(queries):
+                    found = self._rescored_search_with_scores(
+                        index, embedding, k=k, filter=filter, score_threshold=score_threshold,
+                        **({"fetch_k": max(fetch_k, k * self.RESCORE_FACTOR)} if filter is not None else {}))
+                    streams[row].append([(score, position, doc) for doc, score in found])
+                continue
+            key = (index.index.d, index.index.metric_type, index._normalize_L2, index.distance_strategy)
+            groups.setdefault(key, []).append(position)
+
+        for (dim, metric, normalize, _), positions in groups.items():
+            group_queries = queries.copy()
+            if normalize:
+                faiss.normalize_L2(group_queries)
+            for row, found in enumerate(self._search_group([indexes[p] for p in positions], positions, metric,
+                                                           group_queries, k, filter, fetch_k, score_threshold)):
+                streams[row].append(found)
+
+        return [[{"content": doc.page_content, "score": round(float(score), 6), "metadata": doc.metadata, "index": position}
+                 for score, position, doc in self._fuse_top_k(row_streams, k)]
+                for row_streams in streams]
+
+    SHARD_CACHE_SIZE = 32  # Сколько объединённых faiss.IndexShards держать в _shard_searchers
+
+    def _shard_searcher(self, group: List[FAISS], metric: int):
+        """
+        faiss.IndexShards поверх индексов группы. Обёртка строится один раз на набор индексов и хранится
+        в _shard_searchers (LRU) не дольше самих баз: когда любая из них удаляется сборщиком мусора
+        (например, вытеснена из кэша баз бота), обёртка удаляется тоже (weakref.finalize), поэтому не держит
+        в памяти вытесненные индексы, а id в ключе не переиспользуются.
+        """
+        if len(group) == 1:
+            return group[0].index
+        key = tuple((id(index.index), index.index.ntotal) for index in group) + (metric,)
+        cached = self._shard_searchers.get(key)
+        if cached is not None:
+            self._shard_searchers.move_to_end(key)
+            return cached
+        searcher = faiss.IndexShards(group[0].index.d, True, True)
+        searcher.metric_type = metric
+        for index in group:
+            searcher.add_shard(index.index)
+        self._shard_searchers[key] = searcher
+        for index in group:
+            weakref.finalize(index, self._shard_searchers.pop, key, None)
+        while len(self._shard_searchers) > self.SHARD_CACHE_SIZE:
+            self._shard_searchers.popitem(last=False)
+        return searcher
+
+    def _search_group(self, group: List[FAISS], positions: List[int], metric: int, queries: np.ndarray, k: int,
+                      filter: Optional[Union[Callable, dict]], fetch_k: int,
+                      score_threshold: Optional[float]) -> List[List[Tuple[float, int, LangDoc]]]:
+        """
+        Один вызов search по группе однотипных индексов. Возвращает для каждого запроса до k кандидатов
+        (оценка, позиция индекса, документ) в порядке убывания оценки.
+        С фильтром из группы берётся fetch_k кандидатов на каждый индекс; если после фильтра для запроса
+        набралось меньше k, этот запрос ищется по индексам группы по отдельности (fetch_k на индекс).
+        """
+        searcher = self._shard_searcher(group, metric)
+        offsets = np.cumsum([0] + [index.index.ntotal for index in group])
+        limit = min(k if filter is None else max(k, fetch_k) * len(group), int(offsets[-1]))
+        distances, ids = searcher.search(queries, limit)
+
+        filter_func = group[0]._create_filter_func(filter) if filter is not None else None
+        relevance_fns = [index._select_relevance_score_fn() for index in group]
+        results = []
+        for row_distances, row_ids in zip(distances, ids):
+            found = []
+            for distance, global_id in zip(row_distances, row_ids):
+                if global_id < 0:
+                    continue
+                shard = int(np.searchsorted(offsets, global_id, side="right")) - 1
+                index = group[shard]
+                doc = index.docstore.search(index.index_to_docstore_id[int(global_id - offsets[shard])])
+                if not isinstance(doc, LangDoc) or (filter_func is not None and not filter_func(doc.metadata)):
+                    continue
+                score = relevance_fns[shard](float(distance))
+                if score_threshold is not None and score < score_threshold:
+                    continue
+                found.append((score, positions[shard], doc))
+                if len(found) == k:
+                    break
+            results.append(found)
+
+        # Всё, что не попало в общий список кандидатов, хуже любого из них: при k найденных результат точный.
+        # Иначе фильтр отсеял почти всех - добираем по индексам отдельно
+        short = [row for row, found in enumerate(results) if len(found) < k]
+        if filter is not None and len(group) > 1 and short and limit < offsets[-1]:
+            for shard, index in enumerate(group):
+                for row, found in zip(short, self._search_group([index], [positions[shard]], metric, queries[short],
+                                                                k, filter, fetch_k, score_threshold)):
+                    results[row].extend(found)
+            for row in short:
+                unique = {}
+                for score, position, doc in results[row]:
+                    unique.setdefault((position, doc.metadata.get("chunk_id", doc.page_content)), (score, position, doc))
+                results[row] = self._fuse_top_k([list(unique.values())], k)
+        return results
+
+    @staticmethod
+    def _fuse_top_k(streams: List[List[Tuple[float, int, LangDoc]]], k: int) -> List[Tuple[float, int, LangDoc]]:
+        """Глобальный top-k из нескольких списков кандидатов: куча размера k, по убыванию оценки"""
+        heap = []
+        for order, (score, position, doc) in enumerate(item for stream in streams for item in stream):
+            entry = (score, -order, position, doc)  # -order: при равных оценках раньше найденный кандидат выше
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+        return [(score, position, doc) for score, _, position, doc in sorted(heap, key=lambda e: e[:2], reverse=True)]
+
     def _process_search_results(self,
                                 text_results: List[LangDoc],
                                 table_results: List[LangDoc],
@@ -1380,12 +4025,33 @@ class DBConstructor(RAGProcessor):
 
     def _get_chunk_by_id(self, chunk_id: str, db_result: dict) -> Optional[LangDoc]:
         """Поиск чанка по ID с проверкой всех хранилищ"""
-        for db_type in ["text_db", "table_db"]:
-            if db_result.get(db_type):
-                for doc in db_result[db_type].docstore._dict.values():
-                    if doc.metadata["chunk_id"] == chunk_id:
-                        return doc
-        return None
+        return self.find_chunk(chunk_id, [db_result.get(db_type) for db_type in ["text_db", "table_db"]])
+
+def _extract_pdf_tables(file_path: str, pages: str) -> List[Tuple[int, str]]:
+    """
+    Рабочая функция пула процессов _parse_pdf: один проход camelot по диапазону страниц.
+    :param pages: Диапазон страниц в формате camelot, например "1-20"
+    :return: Список (номер страницы, таблица в JSON) в порядке следования
+    """
+    tables = read_pdf(file_path, pages=pages, flavor="stream")
+    return [(int(table.page), table.df.to_json()) for table in tables]
+
+
+def _parse_and_chunk_document(file_path: str, settings: dict, params: dict) -> tuple:
+    """
+    Рабочая функция пула процессов build_databases: парсинг и разбиение одного документа.
+    :param settings: Настройки парсинга из DBConstructor._worker_settings
+    :return: (file_path, список чанков, процессорное время рабочего процесса в секундах)
+    """
+    started = time.process_time()
+    constructor = DBConstructor()
+    for name, value in settings.items():
+        setattr(constructor, name, value)
+    constructor.pdf_workers = 1  # Документы уже распределены по процессам, вложенный пул не нужен
+    parsed_chunks = constructor.document_parser(file_path)
+    prepared_chunks = constructor.prepare_chunks(parsed_chunks, file_path, **params)
+    return file_path, prepared_chunks, time.process_time() - started
+
 #===================================================================================================
 class Tester(DBConstructor):
     def __init__(self):
@@ -1422,3 +4088,19 @@ class Tester(DBConstructor):
 
         return self.summary
 
+    def recall_at_k(self, test_db: FAISS, reference_db: FAISS, queries: List[str], k: int = 5, **search_args) -> dict:
+        """
+        Полнота поиска сжатой базы (квантование, ANN-индекс) относительно эталонной плоской базы тех же чанков.
+        :param test_db: Проверяемая база
+        :param reference_db: Эталонная база (плоский индекс float32)
+        :param queries: Вопросы, например из опросника db_tester
+        :param k: Сколько результатов сравнивать
+        :return: {"recall": средняя доля эталонных результатов в выдаче, "per_query": [...]}
+        """
+        per_query = []
+        for query in queries:
+            reference = {r["content"] for r in self.formatted_scored_sim_search_by_cos(reference_db, query, k=k, **search_args)}
+            found = {r["content"] for r in self.formatted_scored_sim_search_by_cos(test_db, query, k=k, **search_args)}
+            per_query.append(len(reference & found) / len(reference) if reference else 1.0)
+        return {"recall": sum(per_query) / len(per_query) if per_query else 0.0, "per_query": per_query}
+